@@ -0,0 +1,117 @@
+import threading
+from typing import Callable
+import Logger
+
+# Circuit states
+CLOSED: str = 'closed'
+OPEN: str = 'open'
+
+
+class CircuitOpen(Exception):
+    """ Raised instead of sending a request while the circuit is open """
+
+
+class CircuitBreaker:
+    """
+        Stops calls to the API once it looks down, so callers fail fast instead of
+        sitting through connection timeouts and retries on every click.
+
+        failure_threshold consecutive failures open the circuit. While it is open a background
+        probe checks the API every probe_interval seconds, backing off up to max_probe_interval,
+        and closes the circuit the first time it gets through. Listeners hear about every change.
+    """
+
+    def __init__(self,
+                 probe_fnx: Callable[[], bool],
+                 failure_threshold: int = 3,
+                 probe_interval: float = 5,
+                 max_probe_interval: float = 2 * 60):
+        """
+        :param probe_fnx: Returns True when the API answers. Must not go through the breaker
+        :param failure_threshold: Consecutive failures that open the circuit
+        :param probe_interval: Seconds between probes right after the circuit opens
+        :param max_probe_interval: Longest the probe interval backs off to
+        """
+        self.probe_fnx = probe_fnx
+        self.failure_threshold: int = failure_threshold
+        self.probe_interval: float = probe_interval
+        self.max_probe_interval: float = max_probe_interval
+        self.state: str = CLOSED
+        self._failures: int = 0
+        self._next_interval: float = probe_interval
+        self._listeners: list = []
+        self._lock: threading.Lock = threading.Lock()
+        self._timer = None
+
+    @property
+    def offline(self) -> bool:
+        return self.state == OPEN
+
+    def add_listener(self, listener: Callable[[str], None]) -> None:
+        """ listener(state) is called from whichever thread changed the state """
+        self._listeners.append(listener)
+
+    def check(self) -> None:
+        """ :raises CircuitOpen: The API is considered down """
+        if self.state == OPEN:
+            raise CircuitOpen('Kroger API is unreachable. Working offline')
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            tripped: bool = self.state == CLOSED and self._failures >= self.failure_threshold
+        if tripped:
+            self.trip()
+
+    def trip(self) -> None:
+        """ Opens the circuit right away and starts probing for recovery """
+        with self._lock:
+            if self.state == OPEN:
+                return
+            self.state = OPEN
+            self._next_interval = self.probe_interval
+        Logger.Logger.log_error('Kroger API unreachable. Switching to offline mode')
+        self._schedule_probe()
+        self._notify(OPEN)
+
+    def _schedule_probe(self) -> None:
+        with self._lock:
+            delay: float = self._next_interval
+            self._next_interval = min(self.max_probe_interval, self._next_interval * 2)
+            self._timer = threading.Timer(delay, self._probe)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _probe(self) -> None:
+        try:
+            recovered: bool = self.probe_fnx()
+        except Exception as e:
+            Logger.Logger.log(f'API probe failed: {e}')
+            recovered = False
+        if not recovered:
+            self._schedule_probe()
+            return
+        with self._lock:
+            self.state = CLOSED
+            self._failures = 0
+            self._timer = None
+        Logger.Logger.log('Kroger API reachable again. Leaving offline mode')
+        self._notify(CLOSED)
+
+    def _notify(self, state: str) -> None:
+        for listener in list(self._listeners):
+            try:
+                listener(state)
+            except Exception as e:
+                Logger.Logger.log_error(f'Error in circuit breaker listener: {e}')
+
+    def stop(self) -> None:
+        """ Cancels any pending probe """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
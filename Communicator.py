@@ -1,55 +1,272 @@
 """
-    Ultimately want program to function even if it can't connect/access the API.
-    Current exit() use will need to go.
+    The program keeps working when it can't reach the API. A CircuitBreaker fails
+    requests fast while the API is down and the caches serve whatever they hold,
+    stale or not, until a background probe sees the API come back.
 
-    Should token management be broken into an "Authenticator" class?
+    Token bookkeeping lives in TokenManager. Communicator still handles the
+    network side of acquiring tokens.
 """
 
 
 import os
+import random
+import threading
+import time
+import email.utils
+from concurrent.futures import Future, ThreadPoolExecutor
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
-import re
 import urllib.parse
-import time
 import datetime
+import CircuitBreaker
 import DBInterface
 import Logger
+import ProductBatcher
+import ProductCache
+import ProductRecord
+import RateLimiter
+import RedirectListener
+import RequestScheduler
+import SearchCache
+import TokenManager
 
 
 class Communicator:
     """
         The DBInterface reference allows Communicator to retrieve
         existing tokens and keep the refresh token updated.
+
+        Every endpoint call goes through a single pooled, keep-alive requests.Session
+        so repeated calls reuse the same TCP+TLS connection to the API.
     """
-    def __init__(self, db_interface: DBInterface):
+    max_search_start: int = 250  # filter.start runs 1 to 250 on the products endpoint
+    max_page_size: int = 50  # Highest filter.limit the products endpoint accepts. Caps multi-ID lookups too
+    availability_max_age: float = 60 * 60  # Stock levels move faster than the product cache ttl
+    retry_statuses: set = {429, 500, 502, 503, 504}
+    rejection_statuses: set = {400, 422}  # The cart refused the items themselves, not the request
+    # filter.fulfillment codes and the matching product fulfillment flags
+    fulfillment_flags: dict = {
+        'ais': 'inStore',
+        'csp': 'curbside',
+        'dth': 'delivery',
+        'sth': 'shipToHome'
+    }
+
+    def __init__(self,
+                 db_interface: DBInterface,
+                 pool_size: int = 10,
+                 product_ttl: float = 24 * 60 * 60,
+                 search_ttl: float = 24 * 60 * 60,
+                 rate_limit: float = 10,
+                 burst: int = 10,
+                 max_retries: int = 4,
+                 fulfillment: str = 'csp',
+                 location_ids: list[str] = None,
+                 timeout: tuple = (3.05, 10),
+                 api_base: str = None):
+        """
+        :param timeout: (connect, read) seconds for every request
+        :param api_base: e.g. a FakeKroger's. Defaults to kroger_api_base in the environment, then the live API
+        """
         # API details
-        self.api_base: str = 'https://api.kroger.com/v1/'
+        api_base = api_base or os.getenv('kroger_api_base') or 'https://api.kroger.com/v1/'
+        self.api_base: str = api_base if api_base.endswith('/') else api_base + '/'
         self.api_token: str = 'connect/oauth2/token'
         self.api_authorize: str = 'connect/oauth2/authorize'  # "human" consent w/ redirect endpoint
         self.redirect_uri: str = 'http://localhost:8000'
-        self.location_id: str = os.getenv('kroger_api_location_id')
+        self.location_id: str = os.getenv('kroger_api_location_id') or '70100140'
+        # Stores to compare prices across. Comma separated in the environment
+        if location_ids is None:
+            location_ids = [loc for loc in os.getenv('kroger_api_location_ids', '').split(',') if loc]
+        self.location_ids: list[str] = location_ids or [self.location_id]
+        self.fulfillment: str = fulfillment  # Key of fulfillment_flags
         # App credentials
         self.client_id = os.getenv('kroger_app_client_id')
         self.client_secret = os.getenv('kroger_app_client_secret')
-        # Token management
+        # Connection pooling. Session must exist before the token calls below
+        self.session: requests.Session = self._build_session(pool_size)
+        self.timeout: tuple = timeout
+        # Fails requests fast while the API is down. Must exist before the token calls below
+        self.circuit_breaker = CircuitBreaker.CircuitBreaker(self._probe)
+        self._preconnect()
         self.db_interface: DBInterface = db_interface
+        # Throttling, quota accounting and retries for every endpoint call
+        self.rate_limiter = RateLimiter.RateLimiter(rate_limit, burst)
+        self.scheduler = RequestScheduler.RequestScheduler(self.db_interface, self.rate_limiter)
+        self.max_retries: int = max_retries
+        self.backoff_base: float = .5
+        self.backoff_cap: float = 30
+        # Longer Retry-After waits give up instead of blocking the caller. Interactive calls run on the Tk thread
+        self.max_retry_after: dict = {
+            RequestScheduler.INTERACTIVE: 5,
+            RequestScheduler.BACKGROUND: 2 * 60
+        }
+        # Collects product lookups into multi-ID requests. One batcher per store
+        self.product_batchers: dict[str, ProductBatcher.ProductBatcher] = {}
+        self._batcher_lock: threading.Lock = threading.Lock()
+        # Product lookups are served from cache while fresh
+        self.product_cache = ProductCache.ProductCache(self.db_interface,
+                                                       self._submit_lookup,
+                                                       self._flush_lookups,
+                                                       ttl=product_ttl)
+        self.search_cache = SearchCache.SearchCache(self.db_interface, ttl=search_ttl)
+        # Warms the product cache off the GUI thread. One worker keeps prefetching gentle
+        self._prefetch_executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=1)
+        # Token management
+        self.token_manager = TokenManager.TokenManager(self.db_interface, self._exchange_refresh_token)
         tokens: dict = self.init_tokens()
-        self.access_token: str = tokens['access_token']
-        self.access_token_timestamp: float = tokens['access_timestamp']
-        self.refresh_token: str = tokens['refresh_token']
-        self.refresh_token_timestamp: float = tokens['refresh_timestamp']
+        self.token_manager.set_tokens(tokens['access_token'],
+                                      tokens['access_timestamp'],
+                                      tokens['refresh_token'],
+                                      tokens['refresh_timestamp'])
+        # Started offline without a usable refresh token? Authorizing once the API is back
+        self._authorizing: threading.Lock = threading.Lock()
+        self.circuit_breaker.add_listener(self._reacquire_tokens)
 
-    def _get_authcode(self) -> str:
+    def _build_session(self, pool_size: int) -> requests.Session:
         """
-        Requires Selenium to emulate customer input, authorizing the app to do it's thing.
-        Kroger includes the authorization code as a param in the redirect url.
+        Keep-alive session shared by every endpoint call.
+        :param pool_size: Max connections kept open to the API host
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({
+            'Accept': 'application/json'
+        })
+        return session
+
+    def _preconnect(self) -> None:
+        """
+        Opens a connection to the API host in the background so the
+        TLS handshake is already done by the time the first real call goes out.
+        """
+        def warm_up():
+            try:
+                self.session.head(self.api_base, timeout=self.timeout)
+            except requests.RequestException as e:
+                Logger.Logger.log(f'Pre-connect to {self.api_base} failed: {e}')
+                self.circuit_breaker.record_failure()
+
+        threading.Thread(target=warm_up, daemon=True).start()
+
+    def _probe(self) -> bool:
+        """ True if the API host answers at all. Bypasses the scheduler and circuit breaker """
+        try:
+            req = self.session.head(self.api_base, timeout=self.timeout)
+        except requests.RequestException:
+            return False
+        return req.status_code < 500
+
+    @property
+    def offline(self) -> bool:
+        """ True while the API is unreachable and only cached data is served """
+        return self.circuit_breaker.offline
+
+    def _send(self,
+              method: str,
+              url: str,
+              endpoint: str,
+              priority: int = RequestScheduler.INTERACTIVE,
+              idempotent: bool = True,
+              **kwargs) -> requests.Response:
+        """
+        Issues a request through the scheduler and pooled session. Every attempt is
+        admitted by the scheduler and counted against the endpoint's daily quota.
+        429s, 5xxs and connection errors are retried with jittered exponential backoff,
+        waiting at least as long as any Retry-After header asks. A 429 also pauses every other caller.
+        A Retry-After longer than max_retry_after allows for the priority isn't waited out:
+        the response is returned as is.
+        Connection errors and 5xxs count against the circuit breaker, and no attempt is made while it is open.
+        :param endpoint: Quota bucket, see RequestScheduler.default_daily_limits
+        :param priority: RequestScheduler.INTERACTIVE or RequestScheduler.BACKGROUND
+        :param idempotent: False for requests that mustn't be applied twice. Those are only retried when the
+                           server can't have seen them: on a 429, or when the connection was never established
+        :param kwargs: Passed along to requests.Session.request
+        :return: The last response. Raises requests.RequestException if the final attempt couldn't connect,
+                 RequestScheduler.QuotaExceeded if the scheduler refused it,
+                 or CircuitBreaker.CircuitOpen if the API is considered down.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        attempt: int = 0
+        while True:
+            self.circuit_breaker.check()
+            self.scheduler.admit(endpoint, priority)
+            try:
+                req = self.session.request(method, url, **kwargs)
+            except requests.RequestException as e:
+                self.circuit_breaker.record_failure()
+                if attempt >= self.max_retries or not (idempotent or self._not_sent(e)):
+                    raise
+                delay: float = self._backoff(attempt)
+                Logger.Logger.log(f'{method} {url} failed ({e}). Retrying in {delay:.2f}s')
+            else:
+                if req.status_code >= 500:
+                    self.circuit_breaker.record_failure()
+                else:
+                    self.circuit_breaker.record_success()
+                if req.status_code not in self.retry_statuses or attempt >= self.max_retries:
+                    return req
+                if not idempotent and req.status_code != 429:
+                    return req
+                retry_after: float = self._retry_after(req)
+                if retry_after > self.max_retry_after[priority]:
+                    Logger.Logger.log_error(f'{method} {url} returned {req.status_code} asking for a '
+                                            f'{retry_after:.0f}s wait. Giving up')
+                    return req
+                delay = max(self._backoff(attempt), retry_after)
+                if req.status_code == 429:
+                    self.rate_limiter.pause(delay)
+                Logger.Logger.log(f'{method} {url} returned {req.status_code}. Retrying in {delay:.2f}s')
+            time.sleep(delay)
+            attempt += 1
 
-        Really need a good way to pause until the page is fully loaded. For now we just pause for 12
-        seconds. That's not great.
+    @staticmethod
+    def _not_sent(e: requests.RequestException) -> bool:
+        """ True when the request failed before a connection was made, so the server never saw it """
+        if isinstance(e, requests.ConnectTimeout):
+            return True
+        reason = getattr(e.args[0], 'reason', None) if e.args else None
+        return isinstance(e, requests.ConnectionError) and isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+    def _backoff(self, attempt: int) -> float:
+        """ Full jitter: anywhere between 0 and the capped exponential delay """
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def _retry_after(self, req: requests.Response) -> float:
+        """ Seconds requested by a Retry-After header (delta-seconds or HTTP date), else 0 """
+        value: str = req.headers.get('Retry-After', '')
+        if not value:
+            return 0.0
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_at = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return 0.0
+        now = datetime.datetime.now(retry_at.tzinfo)
+        return max(0.0, (retry_at - now).total_seconds())
+
+    def _get_authcode(self) -> tuple[int, dict]:
+        """
+        Requires Selenium to emulate customer input, authorizing the app to do it's thing.
+        Kroger includes the authorization code as a param in the redirect url, which a
+        RedirectListener on redirect_uri captures as soon as the browser lands there.
+        :return: (0, {'authorization_code': <>})
+                 (-1, {'error_message': <>})
         """
+        # No point driving a browser at a login page that can't load
+        if not self._probe():
+            self.circuit_breaker.trip()
+            return -1, {'error_message': 'Kroger API is unreachable'}
+
         # Preparing URl
         params: dict = {
             'scope': 'profile.compact cart.basic:write product.compact'
@@ -61,33 +278,36 @@ class Communicator:
         encoded_params = urllib.parse.urlencode(params)
         target_url = self.api_base + self.api_authorize + '?' + encoded_params
 
+        # Listening for the redirect before kicking off the authorization
+        listener = RedirectListener.RedirectListener(self.redirect_uri, expected_state=params['state'])
+        ret = listener.start()
+        if ret[0] != 0:
+            Logger.Logger.log_error('Error retrieving authorization code -- ' + ret[1]['error_message'])
+            return ret
+
         # Navigating with Selenium
         browser = webdriver.Firefox()
-        browser.get(target_url)
-
-        # Impersonating human authorization
-        username_field = browser.find_element(By.ID, 'username')
-        password_field = browser.find_element(By.ID, 'password')
-        username_field.send_keys(os.getenv('kroger_username'))
-        time.sleep(1)
-        password_field.send_keys(os.getenv('kroger_password'))
-        time.sleep(1)
-        password_field.send_keys(Keys.ENTER)
-
-        time.sleep(12)  # Hacky attempt at waiting for page to fully load
-
-        # Retrieving auth code from the redirect URL
-        full_url = browser.current_url
-        pattern = re.compile(r'\?code=(.*)&')
-        authorization_code: str = pattern.search(full_url).group(1)
-
-        if not authorization_code:
-            Logger.Logger.log_error('Error retrieving authorization code')
-            print("Error retrieving authorization code")
-            print('full_url: ', full_url)
-            exit(1)
+        try:
+            browser.get(target_url)
 
-        return authorization_code
+            # Impersonating human authorization
+            username_field = browser.find_element(By.ID, 'username')
+            password_field = browser.find_element(By.ID, 'password')
+            username_field.send_keys(os.getenv('kroger_username'))
+            password_field.send_keys(os.getenv('kroger_password'))
+            password_field.send_keys(Keys.ENTER)
+
+            # Unblocks the moment the redirect lands
+            ret = listener.wait_for_code(timeout=60)
+        finally:
+            listener.stop()
+            browser.quit()
+
+        if ret[0] != 0:
+            Logger.Logger.log_error('Error retrieving authorization code -- ' + ret[1]['error_message'])
+            print("Error retrieving authorization code")
+            print(ret[1]['error_message'])
+        return ret
 
     def valid_token(self, timestamp: float, token_type: str) -> bool:
         """
@@ -111,6 +331,27 @@ class Communicator:
                 return False
             return True
 
+    def _reacquire_tokens(self, state: str) -> None:
+        """
+        CircuitBreaker listener. Runs the authorization flow when the API comes back and there is
+        no usable refresh token, which is how an app that started offline gets its tokens.
+        """
+        if state != CircuitBreaker.CLOSED:
+            return
+        tokens: dict = self.token_manager.tokens()
+        if tokens['refresh_token'] and self.valid_token(tokens['refresh_timestamp'], token_type='refresh'):
+            return
+        if not self._authorizing.acquire(blocking=False):
+            return  # Already under way
+        try:
+            ret = self.tokens_from_authcode()
+            if ret[0] != 0:
+                Logger.Logger.log_error('Still without API access -- ' + ret[1][0])
+                return
+            self.token_manager.set_tokens(*ret[1])
+        finally:
+            self._authorizing.release()
+
     def tokens_from_authcode(self) -> tuple[int, tuple]:
         """
         Emulates human input to kick start API access.
@@ -118,7 +359,10 @@ class Communicator:
         :return:  (int: 0 upon success, else -1,
                    tuple(access_token, access_timestamp, refresh_token, refresh_timestamp) success, else (None,)
         """
-        authcode: str = self._get_authcode()
+        ret = self._get_authcode()
+        if ret[0] != 0:
+            return -1, (ret[1]['error_message'],)
+        authcode: str = ret[1]['authorization_code']
         headers: dict = {
             'Content-Type': 'application/x-www-form-urlencoded'
         }
@@ -129,8 +373,12 @@ class Communicator:
             , 'code': authcode
         }
         target_url: str = self.api_base + self.api_token
-        req = requests.post(target_url, headers=headers, data=data,
-                            auth=(self.client_id, self.client_secret))
+        try:
+            req = self._send('POST', target_url, 'token', headers=headers, data=data,
+                             auth=(self.client_id, self.client_secret))
+        except (requests.RequestException, RequestScheduler.QuotaExceeded, CircuitBreaker.CircuitOpen) as e:
+            Logger.Logger.log_error(f'Error retrieving tokens with auth code --- {e}')
+            return -1, (str(e),)
         if req.status_code != 200:
             Logger.Logger.log_error('Error retrieving tokens with auth code --- ' + req.text)
             print('error retrieving tokens with authorization_code')
@@ -142,17 +390,18 @@ class Communicator:
         refresh_token: str = req['refresh_token']
         refresh_timestamp: float = access_timestamp
         print("..Tokens retrieved. Writing to database")
-        ret = self.db_interface.update_token(refresh_token, refresh_timestamp)
+        ret = self.db_interface.update_token(refresh_token, refresh_timestamp, access_token, access_timestamp)
         if ret[0] != 0:
             Logger.Logger.log_error('Error updating refresh token from authcode in db' + ret[1])
             exit(1)
         return 0, (access_token, access_timestamp, refresh_token, refresh_timestamp)
 
-    def token_refresh(self):
+    def _exchange_refresh_token(self, refresh_token: str) -> tuple[int, dict]:
         """
-        Pulls new access and refresh tokens using an existing, valid refresh token.
-        Up to caller to verify the refresh token is valid.
-        Updates instance variables directly.
+        Trades a refresh token for new access and refresh tokens.
+        Persisting them is left to the TokenManager.
+        :return: (0, {'access_token': <>, 'refresh_token': <>})
+                 (-1, {'error_message': <>})
         """
         # Prepping request
         headers = {
@@ -160,33 +409,35 @@ class Communicator:
         }
         data = {
             'grant_type': 'refresh_token'
-            , 'refresh_token': self.refresh_token
+            , 'refresh_token': refresh_token
         }
         target_url: str = self.api_base + self.api_token
         # Evaluating response
-        req = requests.post(target_url, headers=headers, data=data,
-                            auth=(self.client_id, self.client_secret))
+        try:
+            req = self._send('POST', target_url, 'token', headers=headers, data=data,
+                             auth=(self.client_id, self.client_secret))
+        except (requests.RequestException, RequestScheduler.QuotaExceeded, CircuitBreaker.CircuitOpen) as e:
+            return -1, {'error_message': f'Error refreshing access token: {e}'}
         if req.status_code != 200:
-            Logger.Logger.log_error('Failed to refresh tokens in token_refresh()' + req.text)
             print("Error refreshing access token")
             print(req.text)
-            exit(1)
+            return -1, {'error_message': 'Error refreshing access token: ' + req.text}
         req = req.json()
-        # Updating token variables
-        self.access_token = req['access_token']
-        self.access_token_timestamp = datetime.datetime.now().timestamp()
-        self.refresh_token = req['refresh_token']
-        self.refresh_token_timestamp = self.access_token_timestamp
-        ret = self.db_interface.update_token(self.refresh_token, self.refresh_token_timestamp)
-        if ret[0] != 0:
-            Logger.Logger.log_error('Error writing new refresh token to DB ' + ret[1])
-            Logger.Logger.log_error('Refresh token is:' + self.refresh_token)
-            exit(1)
+        return 0, {'access_token': req['access_token'], 'refresh_token': req['refresh_token']}
+
+    def token_refresh(self) -> tuple[int, dict]:
+        """
+        Pulls new access and refresh tokens using the existing, valid refresh token.
+        Up to caller to verify the refresh token is valid.
+        """
+        return self.token_manager.refresh()
 
     def init_tokens(self) -> dict:
         """
         Acquires valid access token and refresh tokens
-        however necessary.
+        however necessary. Never blocks on the API: a stale access token is handed to the
+        TokenManager, whose background refresh fires straight away, and if the authorization
+        flow can't complete the tokens are left empty and the app starts offline.
         :return {'access_token: <>,
                   'access_token_timestamp: <> ,
                   'refresh_token': <>,
@@ -206,28 +457,28 @@ class Communicator:
         elif ret[0] == 1:
             # No tokens in the database
             tokens: tuple = self.tokens_from_authcode()
-            access_token = tokens[1][0]
-            access_timestamp = tokens[1][1]
-            refresh_token = tokens[1][2]
-            refresh_timestamp = tokens[1][3]
+            if tokens[0] == 0:
+                access_token, access_timestamp, refresh_token, refresh_timestamp = tokens[1]
+            else:
+                Logger.Logger.log_error('Starting without API access -- ' + tokens[1][0])
         elif ret[0] == 0:
             # Retrieved refresh token
             refresh_token = ret[1][0]
             refresh_timestamp = ret[1][1]
-            if self.valid_token(float(refresh_timestamp), token_type='refresh'):
-                # Exchanging refresh token
-                self.refresh_token = refresh_token
-                self.token_refresh()  # updates token attributes
-                access_token = self.access_token
-                access_timestamp = self.access_token_timestamp
-                refresh_token = self.refresh_token
-                refresh_timestamp = self.refresh_token_timestamp
+            access_token = ret[1][2]
+            access_timestamp = float(ret[1][3])
+            if access_token and self.token_manager.access_fresh(access_timestamp):
+                # Last access token is still good. No need to refresh before startup
+                pass
+            elif self.valid_token(float(refresh_timestamp), token_type='refresh'):
+                # Stale access token. The TokenManager refreshes it in the background
+                pass
             else:
                 tokens: tuple = self.tokens_from_authcode()
-                access_token = tokens[1][0]
-                access_timestamp = tokens[1][1]
-                refresh_token = tokens[1][2]
-                refresh_timestamp = tokens[1][3]
+                if tokens[0] == 0:
+                    access_token, access_timestamp, refresh_token, refresh_timestamp = tokens[1]
+                else:
+                    Logger.Logger.log_error('Starting without API access -- ' + tokens[1][0])
         ret_dict = {
             'access_token': access_token,
             'access_timestamp': access_timestamp,
@@ -236,86 +487,427 @@ class Communicator:
         }
         return ret_dict
 
-    def add_to_cart(self, shopping_list: list[dict]) -> tuple[int, dict]:
+    def add_to_cart(self,
+                    shopping_list: list[dict],
+                    chunk_size: int = 25,
+                    max_workers: int = 4,
+                    chunk_retries: int = 2,
+                    isolate_failures: bool = True) -> tuple[int, dict]:
         """
+        Loads the shopping list into the cart in chunks sent concurrently.
+        cart/add adds quantities, so a chunk is only retried when it can't have been applied: it was
+        throttled (429) or never reached Kroger. A chunk that timed out waiting for a response or got
+        a 5xx may or may not be in the cart, so its items are reported as unknown rather than resent.
+        Chunks Kroger rejects outright (400/422) are split in half recursively until the offending UPCs are
+        found, so every good item still gets loaded.
         :param shopping_list:  [{'upc': <>: str, 'quantity': <>: int}, ... ]
-        :return bool indicating success/failure
+        :param chunk_size: Items per PUT
+        :param max_workers: Chunks in flight at once
+        :param chunk_retries: Extra attempts for a failed chunk
+        :param isolate_failures: Split rejected chunks to pinpoint the bad UPCs
+        :return (0, {'success_message': <>, 'items': [<item result>, ...], 'rejected_upcs': [], 'unknown_upcs': []})
+                (-1, {'error_message': <>, 'items': [<item result>, ...],
+                      'rejected_upcs': [<upc>, ...], 'unknown_upcs': [<upc>, ...]})
+                item result: {'upc': str, 'quantity': int, 'loaded': bool, 'unknown': bool, 'error_message': str}
+                unknown is True when the item may have been loaded even though loaded is False
+        """
+        if not shopping_list:
+            return 0, {'success_message': 'Nothing to load', 'items': [], 'rejected_upcs': [], 'unknown_upcs': []}
+        chunks: list = [shopping_list[i:i + chunk_size] for i in range(0, len(shopping_list), chunk_size)]
+        outcomes: list = [None] * len(chunks)
+        pending: list = list(range(len(chunks)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for attempt in range(chunk_retries + 1):
+                rets: list = list(executor.map(lambda index: self._put_cart(chunks[index]), pending))
+                retry: list = []
+                for index, ret in zip(pending, rets):
+                    outcomes[index] = ret
+                    if ret[0] != 0 and ret[1]['retryable']:
+                        retry.append(index)
+                pending = retry
+                if not pending:
+                    break
+            # Pairing each item with the outcome of the request that carried it
+            item_outcomes: list = [[(item, ret) for item in chunk] for chunk, ret in zip(chunks, outcomes)]
+            if isolate_failures:
+                rejected: list = [index for index, ret in enumerate(outcomes) if self._rejected(ret)]
+                isolated: list = list(executor.map(
+                    lambda index: self._isolate_rejections(chunks[index], outcomes[index]), rejected))
+                for index, pairs in zip(rejected, isolated):
+                    item_outcomes[index] = pairs
+        # Collecting per item results
+        items: list = []
+        rejected_upcs: list = []
+        unknown_upcs: list = []
+        for pairs in item_outcomes:
+            for item, ret in pairs:
+                unknown: bool = ret[0] != 0 and ret[1]['unknown']
+                items.append({
+                    'upc': item['upc'],
+                    'quantity': item['quantity'],
+                    'loaded': ret[0] == 0,
+                    'unknown': unknown,
+                    'error_message': '' if ret[0] == 0 else ret[1]['error_message']
+                })
+                if self._rejected(ret):
+                    rejected_upcs.append(item['upc'])
+                if unknown:
+                    unknown_upcs.append(item['upc'])
+        failed: int = sum(not item['loaded'] for item in items)
+        if failed:
+            return -1, {'error_message': f'Failed to load {failed} of {len(items)} groceries',
+                        'items': items,
+                        'rejected_upcs': rejected_upcs,
+                        'unknown_upcs': unknown_upcs}
+        return 0, {'success_message': 'Successfully loaded groceries into cart',
+                   'items': items,
+                   'rejected_upcs': rejected_upcs,
+                   'unknown_upcs': unknown_upcs}
+
+    @staticmethod
+    def _rejected(ret: tuple[int, dict]) -> bool:
+        """
+        True when Kroger refused the request's contents. Anything else (auth, quota, server trouble)
+        would fail the same way for every subset of the items, so it is reported for the batch as a whole
+        """
+        return ret[0] != 0 and ret[1]['status_code'] in Communicator.rejection_statuses
+
+    def _isolate_rejections(self, items: list[dict], rejection: tuple[int, dict]) -> list[tuple]:
         """
-        if not self.valid_token(self.access_token_timestamp, 'access'):
-            self.token_refresh()
+        Bisects a rejected batch: each half is sent on its own, and halves that are rejected
+        again are split further. Finds k bad UPCs among n items in O(k log n) requests.
+        A rejected PUT adds nothing to the cart, so good items are loaded exactly once.
+        :param rejection: The _put_cart() outcome that rejected items as a whole
+        :return: [(item, _put_cart() outcome), ...] in items order
+        """
+        if len(items) == 1:
+            return [(items[0], rejection)]
+        results: list = []
+        middle: int = len(items) // 2
+        for half in (items[:middle], items[middle:]):
+            ret = self._put_cart(half)
+            if self._rejected(ret):
+                results.extend(self._isolate_rejections(half, ret))
+            else:
+                results.extend((item, ret) for item in half)
+        return results
+
+    def _put_cart(self, items: list[dict]) -> tuple[int, dict]:
+        """
+        One PUT to cart/add. Never resent once it may have reached Kroger, see add_to_cart
+        :return (0, {})
+                (-1, {'error_message': <>, 'status_code': <int or None>, 'retryable': bool, 'unknown': bool})
+                retryable: Kroger can't have applied the PUT, so sending it again is safe
+                unknown: Kroger may have applied the PUT
+        """
+        access_token: str = self.token_manager.get_access_token()
         headers: dict = {
             'Content-Type': 'application/x-www-form-urlencoded'
-            , 'Authorization': f'Bearer {self.access_token}'
+            , 'Authorization': f'Bearer {access_token}'
         }
         data: dict = {
-            'items': shopping_list
+            'items': items
         }
         target_url: str = f'{self.api_base}cart/add'
-        req = requests.put(target_url, headers=headers, json=data)
+        try:
+            req = self._send('PUT', target_url, 'cart', headers=headers, json=data, idempotent=False)
+        except requests.RequestException as e:
+            Logger.Logger.log_error(f'Error adding to cart {e}')
+            not_sent: bool = self._not_sent(e)
+            return -1, {'error_message': f'Failed to load groceries: {e}',
+                        'status_code': None,
+                        'retryable': not_sent,
+                        'unknown': not not_sent}
+        except (RequestScheduler.QuotaExceeded, CircuitBreaker.CircuitOpen) as e:
+            Logger.Logger.log_error(f'Error adding to cart {e}')
+            return -1, {'error_message': f'Failed to load groceries: {e}',
+                        'status_code': None,
+                        'retryable': False,
+                        'unknown': False}
         if req.status_code != 204:
             Logger.Logger.log_error('Error adding to cart ' + req.text)
             print("error adding items to cart")
             print(req.status_code)
             print(req.text)
-            return -1, {'error_message': f'Failed to load groceries: ' + req.text}
-        return 0, {'success_message': 'Successfully loaded groceries into cart'}
+            return -1, {'error_message': f'Failed to load groceries: ' + req.text,
+                        'status_code': req.status_code,
+                        'retryable': req.status_code == 429,
+                        'unknown': req.status_code >= 500}
+        return 0, {}
 
-    def search_products(self, search_string: str) -> tuple[int, dict]:
+    def search_products(self,
+                        search_string: str,
+                        limit: int = 5,
+                        priority: int = RequestScheduler.INTERACTIVE) -> tuple[int, dict]:
+        """
+        Product search by term. Served from the search cache when it can answer,
+        with stale results too while offline.
+        :param limit: Max results, 1-50
+        :param priority: RequestScheduler.INTERACTIVE or RequestScheduler.BACKGROUND
+        :return: (0, {'data': [<ProductRecord>, ...]})
+        """
         if len(search_string) < 4:
             return -1, {'error_message': 'String must be at least 3 characters'}
+        cached = self.search_cache.get(search_string, self.location_id, self.fulfillment, limit,
+                                       stale_ok=self.offline)
+        if cached is not None:
+            return 0, {'data': cached}
+        ret = self._search_page(search_string, 1, limit, priority)
+        if ret[0] != 0:
+            return ret
+        data: list = ret[1]['data']
+        total = ret[1]['total']
+        # Fewer hits than asked for means Kroger had nothing more to give
+        complete: bool = len(data) < limit or (total is not None and total <= len(data))
+        self.search_cache.put(search_string, self.location_id, self.fulfillment, limit, data, complete)
+        return 0, {'data': data}
 
-        if not self.valid_token(self.access_token_timestamp, 'access'):
-            self.token_refresh()
-        # headers: dict = {
-        #     'Content-Type': 'application/x-www-form-urlencoded'
-        #     , 'Authorization': f'Bearer {self.access_token}'
-        # }
+    def iter_search_products(self,
+                             search_string: str,
+                             limit: int = None,
+                             page_size: int = 50,
+                             priority: int = RequestScheduler.INTERACTIVE):
+        """
+        Generator yielding a ProductRecord for every product matching the search term, one page at a time.
+        The next page is fetched in the background while the caller works through the current one.
+        Stops early on an API error (logged).
+        :param limit: Max products to yield. None for every match the API will page through.
+        :param page_size: Products per request, 1-50
+        :param priority: RequestScheduler.INTERACTIVE or RequestScheduler.BACKGROUND
+        """
+        if len(search_string) < 4:
+            return
+        if limit is not None:
+            page_size = min(page_size, limit)
+        yielded: int = 0
+        start: int = 1  # Lowest filter.start the products endpoint accepts, same as search_products
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            next_page = executor.submit(self._search_page, search_string, start, page_size, priority)
+            while next_page is not None:
+                ret = next_page.result()
+                next_page = None
+                if ret[0] != 0:
+                    Logger.Logger.log_error(f'Stopped paging search {search_string} -- ' + ret[1]['error_message'])
+                    return
+                data: list = ret[1]['data']
+                total = ret[1]['total']
+                start += len(data)
+                # Reading ahead while the caller consumes this page
+                more_wanted: bool = limit is None or yielded + len(data) < limit
+                more_available: bool = (len(data) == page_size
+                                        and (total is None or start <= total)
+                                        and start <= self.max_search_start)
+                if more_wanted and more_available:
+                    next_page = executor.submit(self._search_page, search_string, start, page_size, priority)
+                for product in data:
+                    if limit is not None and yielded >= limit:
+                        return
+                    yield product
+                    yielded += 1
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
 
+    def _search_page(self,
+                     search_string: str,
+                     start: int,
+                     limit: int,
+                     priority: int = RequestScheduler.INTERACTIVE) -> tuple[int, dict]:
+        """
+        One page of product search results.
+        :return: (0, {'data': [<ProductRecord>, ...], 'total': <total matches, or None if not reported>})
+                 (-1, {'error_message': <>}) upon failure
+        """
+        access_token: str = self.token_manager.get_access_token()
         headers: dict = {
             'Accept': 'application/json'
-            , 'Authorization': f'Bearer {self.access_token}'
+            , 'Authorization': f'Bearer {access_token}'
         }
 
         params = {
             'filter.term': search_string,
-            'filter.locationId': '70100140',
-            'filter.fulfillment': 'csp',
-            'filter.start': '1',
-            'filter.limit': '5',
+            'filter.locationId': self.location_id,
+            'filter.fulfillment': self.fulfillment,
+            'filter.start': str(start),
+            'filter.limit': str(limit),
         }
-        # encoded_params = urllib.parse.urlencode(params)
-        # target_url: str = f'{self.api_base}products/{encoded_params}'
         target_url: str = f'{self.api_base}products'
 
-        req = requests.get(target_url, headers=headers, params=params)
+        try:
+            req = self._send('GET', target_url, 'products', priority, headers=headers, params=params)
+        except (requests.RequestException, RequestScheduler.QuotaExceeded, CircuitBreaker.CircuitOpen) as e:
+            Logger.Logger.log_error(f'Error searching for product: {e}')
+            return -1, {'error_message': f'Error searching for {search_string}: {e}'}
         if req.status_code != 200:
             Logger.Logger.log_error(f'Error searching for product: {req.text}')
             print(f'Status code: {req.status_code}')
             print(f'Status code: {req.text}')
-            exit(1)
+            return -1, {'error_message': f'Error searching for {search_string}: {req.text}'}
+        results: dict = req.json()
+        records: list = [ProductRecord.ProductRecord.from_json(product) for product in results.get('data', [])]
+        total = results.get('meta', {}).get('pagination', {}).get('total')
+        return 0, {'data': records, 'total': total}
 
-        return 0, req.json()
+    def _batcher(self, location_id: str) -> ProductBatcher.ProductBatcher:
+        with self._batcher_lock:
+            if location_id not in self.product_batchers:
+                self.product_batchers[location_id] = ProductBatcher.ProductBatcher(
+                    lambda upcs, priority: self.products_by_ids(upcs, priority, location_id),
+                    max_batch_size=self.max_page_size)
+            return self.product_batchers[location_id]
 
-    def product_details(self, upc):
+    def _submit_lookup(self, upc: str, location_id: str, priority: int) -> Future:
+        return self._batcher(location_id).submit(upc, priority)
 
-        if not self.valid_token(self.access_token_timestamp, 'access'):
-            self.token_refresh()
+    def _flush_lookups(self) -> None:
+        with self._batcher_lock:
+            batchers: list = list(self.product_batchers.values())
+        for batcher in batchers:
+            batcher.flush()
+
+    def products_by_ids(self,
+                        upcs: list[str],
+                        priority: int = RequestScheduler.INTERACTIVE,
+                        location_id: str = None) -> tuple[int, dict]:
+        """
+        Looks up several products in one request through the products endpoint's
+        comma-separated filter.productId list.
+        :param upcs: At most max_page_size UPCs
+        :param location_id: Store to price against. Defaults to self.location_id
+        :param priority: RequestScheduler.INTERACTIVE or RequestScheduler.BACKGROUND
+        :return: (0, {<upc>: <ProductRecord>}). UPCs Kroger didn't return are left out.
+                 (-1, {'error_message': <>}) upon failure
+        """
+        access_token: str = self.token_manager.get_access_token()
         headers: dict = {
-            'Content-Type': 'application/x-www-form-urlencoded'
-            , 'Authorization': f'Bearer {self.access_token}'
+            'Authorization': f'Bearer {access_token}'
         }
         params = {
-            'filter.locationId': '70100140',
+            'filter.productId': ','.join(upcs),
+            'filter.locationId': location_id or self.location_id,
+            # Results are paged like any search. The default page would drop most of the batch
+            'filter.limit': str(len(upcs)),
         }
-        target_url: str = f'{self.api_base}products/{upc}'
+        target_url: str = f'{self.api_base}products'
 
-        req = requests.get(target_url, headers=headers, params=params)
+        try:
+            req = self._send('GET', target_url, 'products', priority, headers=headers, params=params)
+        except (requests.RequestException, RequestScheduler.QuotaExceeded, CircuitBreaker.CircuitOpen) as e:
+            Logger.Logger.log_error(f'Error retrieving product details for {upcs}: {e}')
+            return -1, {'error_message': f'Error retrieving product details: {e}'}
         if req.status_code != 200:
+            Logger.Logger.log_error(f'Error retrieving product details for {upcs}: {req.status_code} {req.text}')
             print(f'Error retrieving product details: {req.text}')
             print(f'Error retrieving product details: {req.status_code}')
-            exit(1)
+            return -1, {'error_message': f'Error retrieving product details: {req.text}'}
+        # Splitting the response back out per UPC
+        wanted: set = set(upcs)
+        products: dict = {}
+        for product in req.json().get('data', []):
+            record = ProductRecord.ProductRecord.from_json(product)
+            for key in (product.get('productId'), product.get('upc')):
+                if key in wanted:
+                    products[key] = record
+        return 0, products
+
+    def product_details(self, upc: str, priority: int = RequestScheduler.INTERACTIVE) -> tuple[int, dict]:
+        """
+        Looks up a single product by UPC. Served from the product cache while fresh (or at any
+        age while offline), otherwise the lookup rides along with any other pending lookups in the next multi-ID request.
+        :return: (0, {'data': <ProductRecord>}) upon success
+                 (-1, {'error_message': <>}) upon failure
+        """
+        return self.product_cache.get(upc, self.location_id, priority, stale_ok=self.offline)
 
-        return 0, req.json()
+    def product_details_many(self,
+                             upcs: list[str],
+                             priority: int = RequestScheduler.INTERACTIVE,
+                             max_age: float = None,
+                             location_id: str = None) -> list[tuple[int, dict]]:
+        """
+        product_details for many UPCs. Cache misses are packed into maximum-sized
+        multi-ID requests which are sent concurrently.
+        :param upcs: [<upc>: str, ...]
+        :param max_age: Seconds. Refetch cached products older than this. Ignored while offline
+        :param location_id: Store to price against. Defaults to self.location_id
+        :return: [product_details() result, ...] in the same order as upcs
+        """
+        if not upcs:
+            return []
+        return self.product_cache.get_many(upcs, location_id or self.location_id, priority, max_age,
+                                           stale_ok=self.offline)
 
+    def prefetch(self, upcs: list[str]) -> Future:
+        """
+        Fetches the products at every configured store in the background, at background priority,
+        so later lookups are served from the product cache. Returns immediately.
+        Anything already cached and younger than availability_max_age is left alone.
+        :return: Future resolving once every store has been fetched
+        """
+        def fetch():
+            for location_id in self.location_ids:
+                rets: list = self.product_details_many(upcs,
+                                                       RequestScheduler.BACKGROUND,
+                                                       self.availability_max_age,
+                                                       location_id)
+                failed: int = sum(ret[0] != 0 for ret in rets)
+                if failed:
+                    Logger.Logger.log(f'Prefetch missed {failed} of {len(upcs)} products at {location_id}')
 
+        return self._prefetch_executor.submit(fetch)
 
+    def check_availability(self, upcs: list[str], max_age: float = None) -> tuple[int, dict]:
+        """
+        Concurrent availability check at the configured location, reusing cached product
+        data younger than max_age. Products whose lookup failed (quota, server trouble, offline)
+        are reported as unchecked rather than unavailable.
+        :param max_age: Seconds. Defaults to availability_max_age
+        :return: (0, {'available': [<upc>, ...],
+                      'unavailable': [{'upc': <>, 'reason': <>}, ...],
+                      'unchecked': [{'upc': <>, 'reason': <>}, ...]})
+        """
+        if max_age is None:
+            max_age = self.availability_max_age
+        available: list = []
+        unavailable: list = []
+        unchecked: list = []
+        for upc, ret in zip(upcs, self.product_details_many(upcs, max_age=max_age)):
+            if ret[0] != 0:
+                unchecked.append({'upc': upc, 'reason': ret[1]['error_message']})
+                continue
+            flag: str = self.fulfillment_flags.get(self.fulfillment, 'curbside')
+            is_available, reason = ret[1]['data'].available(flag)
+            if is_available:
+                available.append(upc)
+            else:
+                unavailable.append({'upc': upc, 'reason': reason})
+        return 0, {'available': available, 'unavailable': unavailable, 'unchecked': unchecked}
+
+    def compare_prices(self, shopping_list: list[dict], location_ids: list[str] = None) -> tuple[int, dict]:
+        """
+        Prices the shopping list at several stores at once. Every store's lookups run
+        concurrently and share the product cache.
+        :param shopping_list: [{'upc': <>: str, 'quantity': <>: int}, ... ]
+        :param location_ids: Defaults to self.location_ids
+        :return: (0, {'totals': {<location_id>: {'total': float, 'missing': [<upc>, ...]}},
+                      'prices': {<upc>: {<location_id>: <unit price or None>}}})
+        """
+        location_ids = location_ids or self.location_ids
+        upcs: list = [item['upc'] for item in shopping_list]
+        with ThreadPoolExecutor(max_workers=len(location_ids)) as executor:
+            lookups: list = list(executor.map(lambda loc: self.product_details_many(upcs, location_id=loc),
+                                              location_ids))
+        totals: dict = {}
+        prices: dict = {upc: {} for upc in upcs}
+        for location_id, rets in zip(location_ids, lookups):
+            total: float = 0.0
+            missing: list = []
+            for item, ret in zip(shopping_list, rets):
+                price = ret[1]['data'].price if ret[0] == 0 else None
+                prices[item['upc']][location_id] = price
+                if price is None:
+                    missing.append(item['upc'])
+                else:
+                    total += price * item['quantity']
+            totals[location_id] = {'total': round(total, 2), 'missing': missing}
+        return 0, {'totals': totals, 'prices': prices}
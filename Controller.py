@@ -1,5 +1,6 @@
 import Communicator
 import DBInterface
+import Logger
 import Model
 
 
@@ -7,10 +8,14 @@ class Controller:
 
     def __init__(self, db_path: str):
         self.db_interface = DBInterface.DBInterface(db_path)
+        # Never blocks on the API. Communicator falls back to offline mode when it can't be reached
         self.communicator = Communicator.Communicator(self.db_interface)
-        # @TODO Check if communicator is working, else disable API features but work otherwise
         self.model = Model.Model(self.db_interface)
 
+    def offline(self) -> bool:
+        """ True while the API can't be reached. Recipe editing works regardless """
+        return self.communicator.offline
+
     def new_recipe(self) -> tuple[int, dict]:
         """ Returns the recipe_id upon success """
         return self.model.new_recipe()
@@ -24,8 +29,15 @@ class Controller:
         return self.model.recipes
 
     def toggle_recipe(self, recipe_id: int) -> None:
-        """ (de)select a given recipe """
-        self.model.toggle_recipe(recipe_id)
+        """
+        (de)select a given recipe. Newly selected recipes have their products
+        fetched in the background so loading the cart or comparing stores finds them cached.
+        """
+        selected: bool = self.model.toggle_recipe(recipe_id)
+        if selected and not self.offline():
+            # Committing pending edits first: their open transaction would hold up the cache writes
+            self.db_interface.flush()
+            self.communicator.prefetch(self.model.recipe_upcs(recipe_id))
 
     def edit_recipe(self, recipe_id: int, change: dict) -> tuple[int, dict]:
         """
@@ -46,13 +58,90 @@ class Controller:
             return -1, {'error_message': f'Failed to edit {recipe_id}: {change} is not valid'}
         return valid_changes[desired_change](recipe_id, change)
 
-    def load_cart(self) -> tuple[int, dict]:
+    def load_cart(self, force: bool = False) -> tuple[int, dict]:
         """
         Query model to return a list of ingredients based on
-        all of the selected recipes. Hand off to Communicator.
+        all of the selected recipes, less whatever has already been pushed
+        since the last checkout. Checks every item is available before
+        anything is pushed. Hand off to Communicator.
         Inform View of the outcome.
-        :return:
+        :param force: Push the available items, and any that couldn't be checked, even if some are unavailable
+        :return: (-1, {'error_message': <>,
+                       'unavailable': [{'upc': <>, 'reason': <>}, ...],
+                       'unchecked': [{'upc': <>, 'reason': <>}, ...]})
+                 when the pre-flight check finds unavailable or unchecked items and force is False
+        """
+        if self.offline():
+            return -1, {'error_message': 'Kroger API is unreachable. The cart can be loaded once it is back'}
+        # Committing pending edits first: their open transaction would hold up the quota and cache writes
+        self.db_interface.flush()
+        ret = self.model.cart_delta()
+        if ret[0] != 0:
+            return ret
+        shopping_list: list = ret[1]
+        if not shopping_list:
+            return 0, {'success_message': 'Cart already holds everything selected'}
+        # Pre-flight availability check
+        ret = self.communicator.check_availability([item['upc'] for item in shopping_list])
+        unavailable: list = ret[1]['unavailable']
+        unchecked: list = ret[1]['unchecked']
+        if (unavailable or unchecked) and not force:
+            references: dict = self.model.ingredients_for_upcs([item['upc'] for item in unavailable + unchecked])
+            lines: list = []
+            for items, heading in ((unavailable, 'are unavailable'), (unchecked, "couldn't be checked")):
+                if items:
+                    lines.append(f'{len(items)} of {len(shopping_list)} items {heading}:')
+                for item in items:
+                    lines.append(f"{item['upc']} ({item['reason']}) -- {', '.join(references[item['upc']])}")
+            return -1, {'error_message': '\n'.join(lines), 'unavailable': unavailable, 'unchecked': unchecked}
+        if unavailable:
+            missing: set = {item['upc'] for item in unavailable}
+            shopping_list = [item for item in shopping_list if item['upc'] not in missing]
+        ret = self.communicator.add_to_cart(shopping_list)
+        # Items that may have gone in are journaled too. Pushing them again could double them
+        loaded: list = [{'upc': item['upc'], 'quantity': item['quantity']}
+                        for item in ret[1].get('items', []) if item['loaded'] or item['unknown']]
+        journal_ret = self.model.record_cart_push(loaded)
+        if journal_ret[0] != 0:
+            Logger.Logger.log_error('Error recording cart push -- ' + journal_ret[1]['error_message'])
+        if ret[0] != 0 and ret[1].get('rejected_upcs'):
+            # Pointing the user at the ingredients holding the UPCs Kroger refused
+            references: dict = self.model.ingredients_for_upcs(ret[1]['rejected_upcs'])
+            ret[1]['rejected_ingredients'] = references
+            lines: list = [ret[1]['error_message'], 'Rejected UPCs:']
+            for upc, ingredients in references.items():
+                lines.append(f"{upc} -- {', '.join(ingredients)}")
+            ret[1]['error_message'] = '\n'.join(lines)
+        if ret[0] != 0 and ret[1].get('unknown_upcs'):
+            references: dict = self.model.ingredients_for_upcs(ret[1]['unknown_upcs'])
+            lines: list = [ret[1]['error_message'], 'Check the cart for these, they may or may not have been added:']
+            for upc, ingredients in references.items():
+                lines.append(f"{upc} -- {', '.join(ingredients)}")
+            ret[1]['error_message'] = '\n'.join(lines)
+        return ret
+
+    def compare_stores(self) -> tuple[int, dict]:
+        """
+        Prices the selected recipes' shopping list at every configured store.
+        Uses whatever prices are cached while offline.
+        :return: See Communicator.compare_prices, plus 'offline': bool
         """
         shopping_list: list = self.model.desired_ingredients()
-        return self.communicator.add_to_cart(shopping_list)
+        if not shopping_list:
+            return -1, {'error_message': 'No recipes with Kroger UPCs are selected'}
+        # Committing pending edits first: their open transaction would hold up the quota and cache writes
+        self.db_interface.flush()
+        ret = self.communicator.compare_prices(shopping_list)
+        ret[1]['offline'] = self.offline()
+        return ret
+
+    def shutdown(self) -> None:
+        """ Commits any pending recipe edits and stops background work. Called as the window closes """
+        self.communicator.token_manager.stop()
+        self.communicator.circuit_breaker.stop()
+        self.db_interface.close()
+
+    def checked_out(self) -> tuple[int, dict]:
+        """ The cart was checked out, so the next load starts from an empty cart """
+        return self.model.reset_cart_journal()
 
@@ -1,15 +1,247 @@
+import atexit
+import contextlib
 import sqlite3
+import threading
 import Logger
 import copy
 
 
 class DBInterface:
+    """
+        Every thread gets its own connection and cursor, so the GUI, Communicator's workers
+        and anything else reading the database never share a cursor (or its lastrowid).
+        The database runs in WAL mode: readers carry on while a writer commits, and writers
+        queue behind each other for up to busy_timeout.
 
-    def __init__(self, db_path: str):
+        Connections left behind by finished threads go back into a small idle pool for the
+        next new thread. db_path can't be ':memory:', each connection would get its own database.
+
+        The schema is versioned through PRAGMA user_version. migrate() runs on startup and
+        upgrades an existing database in place, one migration per transaction.
+
+        Recipe edits are committed write-behind: edits made within commit_delay of each other
+        share one commit, and batch() groups a block of edits into a single transaction.
+        The editing thread reads its own uncommitted edits. Other threads see them once
+        flushed. Pending edits are flushed by close() and at interpreter exit.
+        Each connection has a lock its thread holds through every edit and batch, so a flush
+        from another thread never commits half of one. Pending edits hold SQLite's write lock,
+        so callers flush() before starting work that writes from other threads (API calls
+        write quota counts and cached products).
+    """
+
+    schema_version: int = 3
+
+    # Applied to every connection as it is opened
+    pragmas: dict = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',  # Durable across app crashes under WAL, just not power loss
+        'cache_size': -16 * 1024,  # Negative is KiB, per connection
+        'mmap_size': 64 * 1024 * 1024,
+        'busy_timeout': 10 * 1000,  # Milliseconds
+        'temp_store': 'MEMORY',
+        'foreign_keys': 'ON'  # Off by default in SQLite. Needed for the cascading deletes
+    }
+
+    # Queries that must be served from an index, see check_query_plans()
+    hot_queries: dict = {
+        'ingredients by recipe': (""" SELECT * FROM recipe_ingredients WHERE recipe_id = 1 """,
+                                  'recipe_ingredients'),
+        'ingredients by upc': (""" SELECT * FROM recipe_ingredients WHERE kroger_upc = '0000000000000' """,
+                               'recipe_ingredients'),
+        'recipe cascade': (""" DELETE FROM recipe_ingredients WHERE recipe_id = 1 """,
+                           'recipe_ingredients'),
+        'single recipe': (""" SELECT * FROM recipes r left join recipe_ingredients ri on r.recipe_id = ri.recipe_id
+                              WHERE r.recipe_id IN (1) """,
+                          'ri')  # Plans name the alias
+    }
+
+    def __init__(self, db_path: str, pool_size: int = 4, commit_delay: float = .5):
+        """
+        :param pool_size: Most idle connections kept around for reuse
+        :param commit_delay: Seconds a recipe edit may wait to be committed alongside later ones
+        """
         self.db_path: str = db_path
-        self.db_connection: sqlite3.Connection = sqlite3.connect(self.db_path, 10)
-        self.db_connection.row_factory = sqlite3.Row
-        self.db_cursor: sqlite3.Cursor = self.db_connection.cursor()
+        self.pool_size: int = pool_size
+        self._local: threading.local = threading.local()
+        self._owners: dict = {}  # {<thread>: <connection>} for every connection handed out
+        self._idle: list = []
+        self._pool_lock: threading.Lock = threading.Lock()
+        self._connection_locks: dict = {}  # {<connection>: <RLock held while it is mid edit>}
+        # Write-behind commits
+        self.commit_delay: float = commit_delay
+        self._dirty: set = set()  # Connections holding uncommitted edits
+        self._commit_timer = None
+        self._write_lock: threading.RLock = threading.RLock()
+        atexit.register(self.flush)
+        ret = self.migrate()
+        if ret[0] != 0:
+            Logger.Logger.log_error('Error migrating database -- ' + ret[1])
+        ret = self.check_query_plans()
+        if ret[0] != 0:
+            Logger.Logger.log_error('Unindexed queries -- ' + ret[1]['error_message'])
+
+    def _connect(self) -> sqlite3.Connection:
+        connection: sqlite3.Connection = sqlite3.connect(self.db_path, 10, check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+        for pragma, value in DBInterface.pragmas.items():
+            connection.execute(f'PRAGMA {pragma} = {value}')
+        self._connection_locks[connection] = threading.RLock()
+        return connection
+
+    def _thread_connection(self) -> sqlite3.Connection:
+        """ The calling thread's connection, taken from the idle pool or opened on first use """
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            return connection
+        with self._pool_lock:
+            # Reclaiming connections from threads that have finished
+            for thread in [thread for thread in self._owners if not thread.is_alive()]:
+                self._idle.append(self._owners.pop(thread))
+            while len(self._idle) > self.pool_size:
+                closing: sqlite3.Connection = self._idle.pop()
+                self._connection_locks.pop(closing, None)
+                closing.close()
+            connection = self._idle.pop() if self._idle else None
+        if connection is None:
+            connection = self._connect()
+        else:
+            # Keeping the previous thread's pending edits, dropping anything else it left open
+            self.flush()
+            connection.rollback()
+        with self._pool_lock:
+            self._owners[threading.current_thread()] = connection
+        self._local.connection = connection
+        self._local.cursor = connection.cursor()
+        return connection
+
+    @property
+    def db_connection(self) -> sqlite3.Connection:
+        return self._thread_connection()
+
+    @property
+    def db_cursor(self) -> sqlite3.Cursor:
+        self._thread_connection()
+        return self._local.cursor
+
+    def close(self) -> None:
+        """ Flushes pending edits and closes every connection. Threads that use the DBInterface afterwards open new ones """
+        self.flush()
+        with self._pool_lock:
+            connections: list = list(self._owners.values()) + self._idle
+            self._owners = {}
+            self._idle = []
+        for connection in connections:
+            connection.close()
+        self._connection_locks = {}
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def _editing(self):
+        """ Holds the calling thread's connection for the length of an edit, see flush() """
+        with self._connection_locks[self.db_connection]:
+            yield
+
+    def _commit_now(self) -> None:
+        """
+        Commits the calling thread's connection, write-behind edits and all.
+        Inside batch() the batch commits instead.
+        """
+        if getattr(self._local, 'batch_depth', 0):
+            return
+        with self._write_lock:
+            self._dirty.discard(self.db_connection)
+        self.db_connection.commit()
+
+    def _arm_commit_timer(self) -> None:
+        """ Caller must hold self._write_lock """
+        if self._commit_timer is None:
+            self._commit_timer = threading.Timer(self.commit_delay, self.flush)
+            self._commit_timer.daemon = True
+            self._commit_timer.start()
+
+    def _commit_later(self) -> None:
+        """
+        Write-behind commit for the calling thread's edits. The first edit arms a timer,
+        and every edit made before it fires rides along in the same commit.
+        Edits inside batch() are committed by the batch instead.
+        """
+        if getattr(self._local, 'batch_depth', 0):
+            return
+        with self._write_lock:
+            self._dirty.add(self.db_connection)
+            self._arm_commit_timer()
+
+    def flush(self) -> tuple[int, str]:
+        """
+        Commits every pending write-behind edit now. Never waits: a connection whose thread
+        is mid edit or inside batch() stays pending for the next timer (or its batch's commit).
+        """
+        errors: list = []
+        busy: list = []
+        with self._write_lock:
+            if self._commit_timer is not None:
+                self._commit_timer.cancel()
+                self._commit_timer = None
+            dirty: set = self._dirty
+            self._dirty = set()
+        batching: bool = bool(getattr(self._local, 'batch_depth', 0))
+        for connection in dirty:
+            lock = self._connection_locks.get(connection)
+            if lock is None:
+                continue  # Closed
+            if not lock.acquire(blocking=False):
+                busy.append(connection)
+                continue
+            try:
+                if batching and connection is getattr(self._local, 'connection', None):
+                    busy.append(connection)
+                else:
+                    connection.commit()
+            except sqlite3.Error as e:
+                errors.append(str(e))
+            finally:
+                lock.release()
+        if busy:
+            with self._write_lock:
+                self._dirty.update(busy)
+                self._arm_commit_timer()
+        if errors:
+            Logger.Logger.log_error('Error flushing pending edits -- ' + '; '.join(errors))
+            return -1, '; '.join(errors)
+        return 0, 'Flushed pending edits'
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Groups every edit made on this thread inside the block into one transaction,
+        committed as the outermost block exits. Blocks nest. An exception raised out of
+        a block rolls back that block's edits only and propagates. Methods that normally
+        commit straight away (cache and quota writes, tokens, the cart journal) join the batch.
+        Every other thread's writes wait while a block is open, so keep API calls out of it.
+
+        with db_interface.batch():
+            db_interface.retitle_recipe(recipe_id, title)
+            db_interface.update_notes(recipe_id, notes)
+        """
+        connection: sqlite3.Connection = self.db_connection
+        with self._connection_locks[connection]:
+            depth: int = getattr(self._local, 'batch_depth', 0)
+            savepoint: str = f'batch_{depth}'
+            connection.execute(f'SAVEPOINT {savepoint}')
+            self._local.batch_depth = depth + 1
+            try:
+                yield self
+            except BaseException:
+                connection.execute(f'ROLLBACK TO {savepoint}')
+                connection.execute(f'RELEASE {savepoint}')
+                raise
+            else:
+                connection.execute(f'RELEASE {savepoint}')
+            finally:
+                self._local.batch_depth = depth
+            if depth == 0:
+                # Taking any earlier write-behind edits on this connection along
+                self._commit_now()
 
     def manual_debug(self):
         sqlstring: str = """ SELECT *
@@ -45,30 +277,80 @@ class DBInterface:
         :return: [0] == 0 upon success, -1 failure
                  [1] is success/failure message
         """
-        # Clearing existing tables
+        # Clearing existing tables. Children before the tables they reference
         db_tables = [
             'api_token',
-            'recipes',
             'recipe_steps',
-            'recipe_ingredients'
+            'recipe_ingredients',
+            'recipes',
+            'product_cache',
+            'search_cache',
+            'api_quota',
+            'cart_journal'
         ]
         for table in db_tables:
             sqlstring = f""" DROP TABLE IF EXISTS {table} """
             ret = self._execute_query(sqlstring)
             if ret[0] != 0:
                 return ret
-        # Creating token table
+        ret = self._execute_query(""" PRAGMA user_version = 0 """)
+        if ret[0] != 0:
+            return ret
+        ret = self.migrate()
+        if ret[0] != 0:
+            return ret
+        return 0, 'Successfully seeded DB'
+
+    def migrate(self) -> tuple[int, str]:
+        """
+        Brings the schema up to schema_version. Each migration runs in its own
+        transaction together with the user_version bump recording it, so a failed
+        migration leaves the database at the last good version.
+        Safe to run against a current database.
+        """
+        # Index n upgrades user_version n to n + 1
+        migrations: list = [
+            self._migrate_baseline,
+            self._migrate_ingredient_indexes,
+            self._migrate_search_cache_fulfillment
+        ]
+        while True:
+            try:
+                # Taking the write lock up front so concurrent startups migrate one at a time
+                self.db_connection.execute(""" BEGIN IMMEDIATE """)
+                version: int = self.db_connection.execute(""" PRAGMA user_version """).fetchone()[0]
+            except sqlite3.Error as e:
+                return -1, str(e)
+            if version >= len(migrations):
+                self.db_connection.rollback()
+                return 0, f'Schema is at version {version}'
+            ret = migrations[version]()
+            if ret[0] == 0:
+                ret = self._execute_query(f""" PRAGMA user_version = {version + 1} """)
+            if ret[0] != 0:
+                self.db_connection.rollback()
+                return -1, f'Migration to version {version + 1} failed -- ' + ret[1]
+            self.db_connection.commit()
+            Logger.Logger.log(f'Migrated database to version {version + 1}')
+
+    def _migrate_baseline(self) -> tuple[int, str]:
+        """
+        Version 1. The schema as it stood before versioning, for new databases
+        and for ones that predate the access token columns or cache tables.
+        """
         # Only one token row exists at a time. Reuses id 1
-        sqlstring = """ CREATE TABLE api_token (
+        sqlstring = """ CREATE TABLE IF NOT EXISTS api_token (
                         token_id INT PRIMARY KEY,
                         refresh_token TEXT NOT NULL,
-                        timestamp REAL NOT NULL)
+                        timestamp REAL NOT NULL,
+                        access_token TEXT NOT NULL DEFAULT '',
+                        access_timestamp REAL NOT NULL DEFAULT 0)
                     """
         ret: tuple = self._execute_query(sqlstring)
         if ret[0] != 0:
             return ret
         # Creating recipe tables
-        sqlstring = """ CREATE TABLE recipes (
+        sqlstring = """ CREATE TABLE IF NOT EXISTS recipes (
                         recipe_id INTEGER PRIMARY KEY NOT NULL,
                         recipe_title TEXT NOT NULL,
                         recipe_notes TEXT NOT NULL)
@@ -76,7 +358,7 @@ class DBInterface:
         ret = self._execute_query(sqlstring)
         if ret[0] != 0:
             return ret
-        sqlstring = """ CREATE TABLE recipe_ingredients (
+        sqlstring = """ CREATE TABLE IF NOT EXISTS recipe_ingredients (
                         ingredient_id INTEGER PRIMARY KEY,
                         ingredient_name TEXT NOT NULL,
                         ingredient_quantity REAL NOT NULL,
@@ -89,17 +371,307 @@ class DBInterface:
         ret = self._execute_query(sqlstring)
         if ret[0] != 0:
             return ret
+        ret = self._upgrade_token_table()
+        if ret[0] != 0:
+            return ret
+        return self._create_cache_tables()
 
-        return 0, 'Successfully seeded DB'
+    def _migrate_ingredient_indexes(self) -> tuple[int, str]:
+        """
+        Version 2. Indexes recipe_ingredients on recipe_id and kroger_upc and makes
+        ingredients go with their recipe. SQLite can't alter a foreign key, so the table
+        is rebuilt. Ingredients already orphaned by their recipe are dropped along the way.
+        """
+        sqlstrings: list = [
+            """ CREATE TABLE recipe_ingredients_v2 (
+                ingredient_id INTEGER PRIMARY KEY,
+                ingredient_name TEXT NOT NULL,
+                ingredient_quantity REAL NOT NULL,
+                ingredient_unit_type TEXT NOT NULL,
+                kroger_upc CHARACTER(13) NOT NULL,
+                kroger_quantity REAL NOT NULL,
+                recipe_id INT NOT NULL,
+                FOREIGN KEY(recipe_id) REFERENCES recipes(recipe_id) ON DELETE CASCADE)
+            """,
+            """ INSERT INTO recipe_ingredients_v2
+                SELECT ingredient_id
+                       ,ingredient_name
+                       ,ingredient_quantity
+                       ,ingredient_unit_type
+                       ,kroger_upc
+                       ,kroger_quantity
+                       ,recipe_id
+                FROM recipe_ingredients
+                WHERE recipe_id IN (SELECT recipe_id FROM recipes)
+            """,
+            """ DROP TABLE recipe_ingredients """,
+            """ ALTER TABLE recipe_ingredients_v2 RENAME TO recipe_ingredients """,
+            """ CREATE INDEX recipe_ingredients_recipe_id ON recipe_ingredients (recipe_id) """,
+            """ CREATE INDEX recipe_ingredients_kroger_upc ON recipe_ingredients (kroger_upc) """
+        ]
+        for sqlstring in sqlstrings:
+            ret = self._execute_query(sqlstring)
+            if ret[0] != 0:
+                return ret
+        return 0, 'Indexed recipe_ingredients'
+
+    def _migrate_search_cache_fulfillment(self) -> tuple[int, str]:
+        """
+        Version 3. Keys search_cache on fulfillment too, since results depend on filter.fulfillment.
+        Existing rows don't record theirs, so the cache starts over.
+        """
+        sqlstrings: list = [
+            """ DROP TABLE IF EXISTS search_cache """,
+            """ CREATE TABLE search_cache (
+                term TEXT NOT NULL,
+                location_id TEXT NOT NULL,
+                fulfillment TEXT NOT NULL,
+                result_limit INT NOT NULL,
+                results_json TEXT NOT NULL,
+                complete INT NOT NULL,
+                timestamp REAL NOT NULL,
+                PRIMARY KEY (term, location_id, fulfillment))
+            """
+        ]
+        for sqlstring in sqlstrings:
+            ret = self._execute_query(sqlstring)
+            if ret[0] != 0:
+                return ret
+        return 0, 'Keyed search_cache on fulfillment'
+
+    def check_query_plans(self) -> tuple[int, dict]:
+        """
+        Runs EXPLAIN QUERY PLAN over hot_queries to confirm none of them scans its whole table.
+        :return: (0, {<query name>: <plan>, ...})
+                 (-1, {'error_message': <>, 'plans': {<query name>: <plan>, ...}})
+        """
+        plans: dict = {}
+        scans: list = []
+        for name, (sqlstring, table) in DBInterface.hot_queries.items():
+            ret = self._execute_query(""" EXPLAIN QUERY PLAN """ + sqlstring)
+            if ret[0] != 0:
+                return -1, {'error_message': f'{name}: ' + ret[1], 'plans': plans}
+            details: list = [row['detail'] for row in self.db_cursor.fetchall()]
+            plans[name] = '; '.join(details)
+            # Full scans read "SCAN <table>", index lookups "SEARCH <table> USING INDEX ..."
+            if any(detail.startswith(f'SCAN {table}') and 'USING' not in detail for detail in details):
+                scans.append(f'{name} ({plans[name]})')
+        if scans:
+            return -1, {'error_message': 'Full table scans in ' + ', '.join(scans), 'plans': plans}
+        return 0, plans
+
+    def _upgrade_token_table(self) -> tuple[int, str]:
+        """
+        Adds the access token columns to an api_token table created before they existed.
+        No-op for new or already upgraded databases. Left uncommitted for the migration.
+        """
+        ret = self._execute_query(""" PRAGMA table_info(api_token) """)
+        if ret[0] != 0:
+            return ret
+        columns: list = [row['name'] for row in self.db_cursor.fetchall()]
+        if not columns or 'access_token' in columns:
+            return 0, 'api_token table is current'
+        sqlstrings: list = [
+            """ ALTER TABLE api_token ADD COLUMN access_token TEXT NOT NULL DEFAULT '' """,
+            """ ALTER TABLE api_token ADD COLUMN access_timestamp REAL NOT NULL DEFAULT 0 """
+        ]
+        for sqlstring in sqlstrings:
+            ret = self._execute_query(sqlstring)
+            if ret[0] != 0:
+                return ret
+        return 0, 'Upgraded api_token table'
+
+    def _create_cache_tables(self) -> tuple[int, str]:
+        """
+        Creates the API cache tables if they don't exist yet.
+        Safe to run against an existing database. Left uncommitted for the migration.
+        """
+        # One row per product per store
+        sqlstring = """ CREATE TABLE IF NOT EXISTS product_cache (
+                        upc CHARACTER(13) NOT NULL,
+                        location_id TEXT NOT NULL,
+                        product_json TEXT NOT NULL,
+                        timestamp REAL NOT NULL,
+                        PRIMARY KEY (upc, location_id))
+                    """
+        ret = self._execute_query(sqlstring)
+        if ret[0] != 0:
+            return ret
+        # One row per normalized search term per store.
+        # complete == 1 when results holds every match Kroger has for the term
+        sqlstring = """ CREATE TABLE IF NOT EXISTS search_cache (
+                        term TEXT NOT NULL,
+                        location_id TEXT NOT NULL,
+                        result_limit INT NOT NULL,
+                        results_json TEXT NOT NULL,
+                        complete INT NOT NULL,
+                        timestamp REAL NOT NULL,
+                        PRIMARY KEY (term, location_id))
+                    """
+        ret = self._execute_query(sqlstring)
+        if ret[0] != 0:
+            return ret
+        # Calls made per endpoint per (UTC) day
+        sqlstring = """ CREATE TABLE IF NOT EXISTS api_quota (
+                        day TEXT NOT NULL,
+                        endpoint TEXT NOT NULL,
+                        call_count INT NOT NULL,
+                        PRIMARY KEY (day, endpoint))
+                    """
+        ret = self._execute_query(sqlstring)
+        if ret[0] != 0:
+            return ret
+        # Quantities pushed to the Kroger cart since the last checkout
+        sqlstring = """ CREATE TABLE IF NOT EXISTS cart_journal (
+                        kroger_upc CHARACTER(13) PRIMARY KEY,
+                        quantity INT NOT NULL)
+                    """
+        ret = self._execute_query(sqlstring)
+        if ret[0] != 0:
+            return ret
+        return 0, 'Successfully created cache tables'
+
+    def retrieve_cached_product(self, upc: str, location_id: str) -> tuple[int, tuple]:
+        """
+        Pulls the cached product json + unix timestamp, if it exists.
+        Thread safe.
+        :return: int: -1 upon query error.
+                 tuple: Failure message
+                 ||
+                 int: 0, found a cached product
+                 tuple: (str: product_json, float: unix_timestamp)
+                 ||
+                 int: 1, Product not cached
+                 tuple: (None,)
+        """
+        sqlstring: str = """ SELECT product_json, timestamp
+                             FROM product_cache
+                             WHERE upc = (?) AND location_id = (?)
+                         """
+        try:
+            cursor: sqlite3.Cursor = self.db_connection.execute(sqlstring, (upc, location_id))
+            resultrow = cursor.fetchone()
+        except sqlite3.Error as e:
+            return -1, (str(e),)
+        if resultrow is None:
+            return 1, (None,)
+        return 0, (resultrow['product_json'], resultrow['timestamp'])
+
+    def cache_product(self, upc: str, location_id: str, product_json: str, unix_timestamp: float) -> tuple[int, str]:
+        """
+        Insert/replace the product_cache row for (upc, location_id).
+        Thread safe.
+        :return:  (int: -1 upon failure, else 0,
+                   str: outcome message)
+        """
+        sqlstring: str = """ INSERT OR REPLACE INTO product_cache (upc, location_id, product_json, timestamp)
+                             VALUES (?, ?, ?, ?)
+                         """
+        try:
+            self.db_connection.execute(sqlstring, (upc, location_id, product_json, unix_timestamp))
+            self._commit_now()
+        except sqlite3.Error as e:
+            return -1, str(e)
+        return 0, f'Successfully cached product {upc}'
+
+    def retrieve_cached_searches(self, terms: list[str], location_id: str, fulfillment: str) -> tuple[int, list]:
+        """
+        Pulls the search_cache rows for any of the given terms, made with the given filter.fulfillment.
+        Thread safe.
+        :return: (int: -1, [error message])
+                 ||
+                 (int: 0, [{'term': str, 'result_limit': int, 'results_json': str,
+                            'complete': int, 'timestamp': float}, ...])
+        """
+        if not terms:
+            return 0, []
+        placeholders: str = ', '.join('?' * len(terms))
+        sqlstring: str = f""" SELECT term, result_limit, results_json, complete, timestamp
+                              FROM search_cache
+                              WHERE location_id = (?) AND fulfillment = (?) AND term IN ({placeholders})
+                          """
+        try:
+            cursor: sqlite3.Cursor = self.db_connection.execute(sqlstring, (location_id, fulfillment, *terms))
+            rows: list = [dict(row) for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            return -1, [str(e)]
+        return 0, rows
+
+    def cache_search(self,
+                     term: str,
+                     location_id: str,
+                     fulfillment: str,
+                     result_limit: int,
+                     results_json: str,
+                     complete: bool,
+                     unix_timestamp: float) -> tuple[int, str]:
+        """
+        Insert/replace the search_cache row for (term, location_id, fulfillment).
+        Thread safe.
+        :return:  (int: -1 upon failure, else 0,
+                   str: outcome message)
+        """
+        sqlstring: str = """ INSERT OR REPLACE INTO search_cache
+                                (term, location_id, fulfillment, result_limit, results_json, complete, timestamp)
+                             VALUES (?, ?, ?, ?, ?, ?, ?)
+                         """
+        try:
+            self.db_connection.execute(sqlstring, (term, location_id, fulfillment, result_limit,
+                                                   results_json, int(complete), unix_timestamp))
+            self._commit_now()
+        except sqlite3.Error as e:
+            return -1, str(e)
+        return 0, f'Successfully cached search {term}'
+
+    def retrieve_quota_counts(self, day: str) -> tuple[int, dict]:
+        """
+        Pulls the API call counts recorded for the given day.
+        Thread safe.
+        :param day: ISO date e.g. '2021-08-11'
+        :return: (int: -1, {'error_message': <>})
+                 ||
+                 (int: 0, {<endpoint>: <call_count>, ...})
+        """
+        sqlstring: str = """ SELECT endpoint, call_count
+                             FROM api_quota
+                             WHERE day = (?)
+                         """
+        try:
+            cursor: sqlite3.Cursor = self.db_connection.execute(sqlstring, (day,))
+            rows: list = cursor.fetchall()
+        except sqlite3.Error as e:
+            return -1, {'error_message': str(e)}
+        return 0, {row['endpoint']: row['call_count'] for row in rows}
+
+    def increment_quota(self, day: str, endpoint: str) -> tuple[int, str]:
+        """
+        Records one more API call against the endpoint for the given day.
+        Thread safe.
+        :return:  (int: -1 upon failure, else 0,
+                   str: outcome message)
+        """
+        sqlstring: str = """ INSERT INTO api_quota (day, endpoint, call_count)
+                             VALUES (?, ?, 1)
+                             ON CONFLICT (day, endpoint) DO UPDATE SET call_count = call_count + 1
+                         """
+        try:
+            self.db_connection.execute(sqlstring, (day, endpoint))
+            self._commit_now()
+        except sqlite3.Error as e:
+            return -1, str(e)
+        return 0, f'Recorded call to {endpoint}'
 
     def retrieve_token(self) -> tuple[int, tuple]:
         """
-        Pulls the refresh token + unix timestamp, if it exists
+        Pulls the refresh token + unix timestamp, along with the last access token
+        + unix timestamp, if they exist
         :return: int: -1 upon query error.
                  tuple: Failure message
                  ||
                  int: 0, successfully retrieved a token
-                 tuple: (str: refresh_token, float: unix_timestamp)
+                 tuple: (str: refresh_token, float: unix_timestamp,
+                         str: access_token, float: access_unix_timestamp)
+                         access_token is '' when none has been stored
                  ||
                  int: 1, No token found
                  tuple: (None,)
@@ -113,43 +685,95 @@ class DBInterface:
         resultrow: tuple = self.db_cursor.fetchone()
         if resultrow is None:
             return 1, (None,)
-        refresh_token: str = resultrow[1]
-        timestamp: float = resultrow[2]
-        return 0, (refresh_token, timestamp)
+        refresh_token: str = resultrow['refresh_token']
+        timestamp: float = resultrow['timestamp']
+        access_token: str = resultrow['access_token']
+        access_timestamp: float = resultrow['access_timestamp']
+        return 0, (refresh_token, timestamp, access_token, access_timestamp)
 
-    def update_token(self, refresh_token: str, unix_timestamp: float) -> tuple[int, str]:
+    def update_token(self,
+                     refresh_token: str,
+                     unix_timestamp: float,
+                     access_token: str = '',
+                     access_timestamp: float = 0.0) -> tuple[int, str]:
         """
-        Insert/replace the api_token row with the latest refresh_token
+        Insert/replace the api_token row with the latest refresh_token and access_token
         :return:  (int: -1 upon failure, else0,
                    str: outcome message)
         """
-        # Checking for an existing token
-        sqlstring: str = """    SELECT token_id
-                                FROM api_token
+        with self._editing():
+            # Checking for an existing token
+            sqlstring: str = """    SELECT token_id
+                                    FROM api_token
+                                    WHERE token_id = (?)
+                             """
+            ret: tuple = self._execute_query(sqlstring, (1,))
+            if ret[0] != 0:
+                return ret
+            rowdata: tuple = self.db_cursor.fetchone()
+            if rowdata is not None:
+                # Deleting the existing entry
+                sqlstring = """ DELETE FROM api_token
                                 WHERE token_id = (?)
-                         """
-        ret: tuple = self._execute_query(sqlstring, (1,))
-        if ret[0] != 0:
-            return ret
-        rowdata: tuple = self.db_cursor.fetchone()
-        if rowdata is not None:
-            # Deleting the existing entry
-            sqlstring = """ DELETE FROM api_token
-                            WHERE token_id = (?)
+                            """
+                ret = self._execute_query(sqlstring, (1,))
+                if ret[0] != 0:
+                    return ret
+            # Inserting latest token
+            sqlstring = """ INSERT INTO api_token (token_id, refresh_token, timestamp, access_token, access_timestamp)
+                            VALUES (?, ?, ?, ?, ?)
                         """
-            ret = self._execute_query(sqlstring, (1,))
+            ret = self._execute_query(sqlstring, (1, refresh_token, unix_timestamp, access_token, access_timestamp))
             if ret[0] != 0:
                 return ret
-        # Inserting latest token
-        sqlstring = """ INSERT INTO api_token (token_id, refresh_token, timestamp)
-                        VALUES (?, ?, ?)
-                    """
-        ret = self._execute_query(sqlstring, (1, refresh_token, unix_timestamp))
-        if ret[0] != 0:
-            return ret
-        self.db_connection.commit()
+            self._commit_now()
         return 0, 'Successfully updated refresh token'
 
+    def get_cart_journal(self) -> tuple[int, dict]:
+        """
+        Pulls what has been pushed to the cart since the last checkout
+        :return: [int: -1, {'error_message': <>}]
+                    OR
+                 [int: 0, {<kroger_upc>: <quantity>, ...}]
+        """
+        sqlstring: str = """ SELECT kroger_upc, quantity
+                             FROM cart_journal
+                         """
+        ret = self._execute_query(sqlstring)
+        if ret[0] != 0:
+            return -1, {'error_message': ret[1]}
+        results = self.db_cursor.fetchall()
+        return 0, {row['kroger_upc']: row['quantity'] for row in results}
+
+    def record_cart_push(self, items: list[dict]) -> tuple[int, dict]:
+        """
+        Adds freshly pushed quantities to the cart journal. Committed straight away, all or nothing
+        :param items: [{'upc': str, 'quantity': int}, ...]
+        """
+        sqlstring: str = """ INSERT INTO cart_journal (kroger_upc, quantity)
+                             VALUES (?, ?)
+                             ON CONFLICT (kroger_upc) DO UPDATE SET quantity = quantity + excluded.quantity
+                         """
+        try:
+            # A failure only rolls back the batch, pending edits stay
+            with self.batch():
+                for item in items:
+                    ret = self._execute_query(sqlstring, (item['upc'], item['quantity']))
+                    if ret[0] != 0:
+                        raise sqlite3.Error(ret[1])
+        except sqlite3.Error as e:
+            return -1, {'error_message': str(e)}
+        return 0, {}
+
+    def clear_cart_journal(self) -> tuple[int, dict]:
+        """ Forgets everything pushed so far. Used once the cart has been checked out """
+        sqlstring: str = """ DELETE FROM cart_journal """
+        ret = self._execute_query(sqlstring)
+        if ret[0] != 0:
+            return -1, {'error_message': ret[1]}
+        self._commit_now()
+        return 0, {}
+
     def add_recipe(self, recipe: dict) -> tuple[int, dict]:
         """
         Deprecated. Favor is given to new_recipe.
@@ -166,46 +790,48 @@ class DBInterface:
         :return: A deep copy of recipe + the recipe and ingredient ids.
                  'ingredients' dict is re-keyed to ingredient_id
         """
-        # Adding recipe table entry
-        recipe_title: str = recipe['recipe_title']
-        recipe_notes: str = recipe['recipe_notes']
-        sqlstring: str = """ INSERT INTO recipes (recipe_title, recipe_notes)
-                             VALUES (?, ?)
-                         """
-        ret: tuple = self._execute_query(sqlstring, (recipe_title, recipe_notes))
-        if ret[0] != 0:
-            Logger.Logger.log_error(f'Error adding {recipe_title} to database --' + ret[1])
-            print(f' Error adding new recipe {recipe_title} to the database')
-            return -1, {'error_message': f'Error adding {recipe_title} to the database--' + ret[1]}
-        new_recipe_id: int = self.db_cursor.lastrowid
-        # Adding ingredient table entries
-        for ingredient, details in recipe['ingredients'].items():
-            sqlstring = """ INSERT INTO recipe_ingredients
-                            (ingredient_name
-                            ,ingredient_quantity
-                            ,ingredient_unit_type
-                            ,kroger_upc
-                            ,kroger_quantity
-                            ,recipe_id)
-                            VALUES (?, ?, ?, ?, ?, ?)
-                        """
-            ret = self._execute_query(sqlstring, (details['ingredient_name'],
-                                                  details['ingredient_quantity'],
-                                                  details['ingredient_unit_type'],
-                                                  details['kroger_upc'],
-                                                  details['kroger_quantity'],
-                                                  new_recipe_id))
-            if ret[0] != 0:
-                Logger.Logger.log_error(f'Error adding ingredient {ingredient} --' + ret[1])
-                print(f'Error adding ingredient {ingredient}')
-                # Returning without commit
-                self.db_connection.rollback()
-                return -1, {'error_message': f'Error adding ingredient {ingredient}--' + ret[1]}
-            # Preparing return data
-            new_ingredient_id: int = self.db_cursor.lastrowid
-            recipe['ingredients'][ingredient]['ingredient_id'] = new_ingredient_id
-        # Finalizing
-        self.db_connection.commit()
+        try:
+            # A failure only rolls back the batch, pending edits stay
+            with self.batch():
+                # Adding recipe table entry
+                recipe_title: str = recipe['recipe_title']
+                recipe_notes: str = recipe['recipe_notes']
+                sqlstring: str = """ INSERT INTO recipes (recipe_title, recipe_notes)
+                                     VALUES (?, ?)
+                                 """
+                ret: tuple = self._execute_query(sqlstring, (recipe_title, recipe_notes))
+                if ret[0] != 0:
+                    Logger.Logger.log_error(f'Error adding {recipe_title} to database --' + ret[1])
+                    print(f' Error adding new recipe {recipe_title} to the database')
+                    return -1, {'error_message': f'Error adding {recipe_title} to the database--' + ret[1]}
+                new_recipe_id: int = self.db_cursor.lastrowid
+                # Adding ingredient table entries
+                for ingredient, details in recipe['ingredients'].items():
+                    sqlstring = """ INSERT INTO recipe_ingredients
+                                    (ingredient_name
+                                    ,ingredient_quantity
+                                    ,ingredient_unit_type
+                                    ,kroger_upc
+                                    ,kroger_quantity
+                                    ,recipe_id)
+                                    VALUES (?, ?, ?, ?, ?, ?)
+                                """
+                    ret = self._execute_query(sqlstring, (details['ingredient_name'],
+                                                          details['ingredient_quantity'],
+                                                          details['ingredient_unit_type'],
+                                                          details['kroger_upc'],
+                                                          details['kroger_quantity'],
+                                                          new_recipe_id))
+                    if ret[0] != 0:
+                        Logger.Logger.log_error(f'Error adding ingredient {ingredient} --' + ret[1])
+                        print(f'Error adding ingredient {ingredient}')
+                        # Rolling back the recipe too
+                        raise sqlite3.Error(f'Error adding ingredient {ingredient}--' + ret[1])
+                    # Preparing return data
+                    new_ingredient_id: int = self.db_cursor.lastrowid
+                    recipe['ingredients'][ingredient]['ingredient_id'] = new_ingredient_id
+        except sqlite3.Error as e:
+            return -1, {'error_message': str(e)}
         # 'ingredients' dict needs re-keying
         # on ingredient_id
         ingredient_keys = list(recipe['ingredients'].keys())
@@ -218,9 +844,10 @@ class DBInterface:
         new_recipe['recipe_id'] = new_recipe_id
         return 0, new_recipe
 
-    def get_recipes(self) -> tuple[int, dict]:
+    def get_recipes(self, recipe_ids: list[int] = None) -> tuple[int, dict]:
         """
-        Pulls all recipe data and returns it as nested dictionaries
+        Pulls recipe data and returns it as nested dictionaries
+        :param recipe_ids: Only these recipes, looked up through the recipe_id indexes. None for every recipe
         :return: [int: -1, {'error_message': <>}]
                     OR
                  [int: 0, {<recipe_id>:    {'recipe_id': <>,
@@ -245,9 +872,16 @@ class DBInterface:
                              ,ri.kroger_upc
                              ,ri.kroger_quantity
                              FROM recipes r left join recipe_ingredients ri on r.recipe_id = ri.recipe_id
-                             ORDER BY r.recipe_id
                          """
-        ret: tuple = self._execute_query(sqlstring)
+        parameters: tuple = None
+        if recipe_ids is not None:
+            if not recipe_ids:
+                return 0, {}
+            placeholders: str = ', '.join('?' * len(recipe_ids))
+            sqlstring += f""" WHERE r.recipe_id IN ({placeholders}) """
+            parameters = tuple(recipe_ids)
+        sqlstring += """ ORDER BY r.recipe_id """
+        ret: tuple = self._execute_query(sqlstring, parameters)
         if ret[0] != 0:
             return -1, {'error_message': ret[1]}
         # Structuring data
@@ -277,30 +911,60 @@ class DBInterface:
             new_recipe['ingredients'][ingredient_id] = new_ingredient
         return 0, recipes
 
-    def delete_recipe(self, recipe_id: int) -> tuple[int, dict]:
+    def iter_recipe_headers(self, batch_size: int = 500):
         """
-        Remove the 'recipe_ingredients' and 'recipes' entries
-        for the given recipe_id
-        :return:
+        Generator yielding {'recipe_id': <>, 'recipe_title': <>} for every recipe, reading
+        batch_size rows at a time. Notes and ingredients are left to get_recipe.
+        Runs on its own cursor so other queries can be made mid-iteration.
+        Raises sqlite3.Error on a query error (logged), so a partial list is never mistaken for the whole.
         """
-        # Clearing recipe_ingredients table
-        sqlstring: str = """ DELETE FROM recipe_ingredients 
-                             WHERE recipe_id = (?)
+        sqlstring: str = """ SELECT recipe_id, recipe_title
+                             FROM recipes
+                             ORDER BY recipe_id
                          """
-        ret = self._execute_query(sqlstring, (recipe_id,))
-        print(self.db_cursor.lastrowid)
+        try:
+            cursor: sqlite3.Cursor = self.db_connection.execute(sqlstring)
+            while True:
+                rows: list = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                for row in rows:
+                    yield {'recipe_id': row['recipe_id'], 'recipe_title': row['recipe_title']}
+        except sqlite3.Error as e:
+            Logger.Logger.log_error('Error streaming recipe headers -- ' + str(e))
+            raise
+
+    def get_recipe(self, recipe_id: int) -> tuple[int, dict]:
+        """
+        Pulls a single recipe, see get_recipes
+        :return: [int: 0, <recipe dict>]
+                    OR
+                 [int: 1, {'error_message': <>}] no such recipe
+                    OR
+                 [int: -1, {'error_message': <>}]
+        """
+        ret = self.get_recipes([recipe_id])
         if ret[0] != 0:
-            Logger.Logger.log_error(f'Error deleting recipe_ingredient entries' + ret[1])
-            print(f'Error deleting recipe_ingredient entries:' + ret[1])
-            return -1, {'error_message': ret[1]}
-        # Clearing recipes table
+            return ret
+        if recipe_id not in ret[1]:
+            return 1, {'error_message': f'Recipe {recipe_id} does not exist'}
+        return 0, ret[1][recipe_id]
+
+    def delete_recipe(self, recipe_id: int) -> tuple[int, dict]:
+        """
+        Remove the 'recipes' entry for the given recipe_id.
+        Its 'recipe_ingredients' entries go with it (ON DELETE CASCADE)
+        :return:
+        """
         sqlstring = """ DELETE FROM recipes 
                         WHERE recipe_id = (?)
                     """
-        ret = self._execute_query(sqlstring, (recipe_id,))
-        if ret[0] != 0:
-            return -1, {'error_message': ret[1]}
-        self.db_connection.commit()
+        with self._editing():
+            ret = self._execute_query(sqlstring, (recipe_id,))
+            if ret[0] != 0:
+                Logger.Logger.log_error(f'Error deleting recipe {recipe_id}' + ret[1])
+                return -1, {'error_message': ret[1]}
+            self._commit_later()
         return 0, {'success_message': f'Deleted recipe {recipe_id}'}
 
     def add_ingredient(self, recipe_id: int, ingredient: dict) -> tuple[int, dict]:
@@ -323,26 +987,28 @@ class DBInterface:
                                 ,recipe_id)
                              VALUES (?, ?, ?, ?, ?, ?)
                          """
-        ret = self._execute_query(sqlstring, (ingredient['ingredient_name'],
-                                              ingredient['ingredient_quantity'],
-                                              ingredient['ingredient_unit_type'],
-                                              ingredient['kroger_upc'],
-                                              ingredient['kroger_quantity'],
-                                              recipe_id))
-        if ret[0] != 0:
-            return -1, {'error_message': ret[1]}
-        ingredient_id: int = self.db_cursor.lastrowid
-        self.db_connection.commit()
+        with self._editing():
+            ret = self._execute_query(sqlstring, (ingredient['ingredient_name'],
+                                                  ingredient['ingredient_quantity'],
+                                                  ingredient['ingredient_unit_type'],
+                                                  ingredient['kroger_upc'],
+                                                  ingredient['kroger_quantity'],
+                                                  recipe_id))
+            if ret[0] != 0:
+                return -1, {'error_message': ret[1]}
+            ingredient_id: int = self.db_cursor.lastrowid
+            self._commit_later()
         return 0, {'ingredient_id': ingredient_id}
 
     def delete_ingredient(self, ingredient_id) -> tuple[int, dict]:
         sqlstring: str = """ DELETE FROM recipe_ingredients
                              WHERE ingredient_id = (?)
                          """
-        ret = self._execute_query(sqlstring, (ingredient_id,))
-        if ret[0] != 0:
-            return -1, {'error_message': ret[1]}
-        self.db_connection.commit()
+        with self._editing():
+            ret = self._execute_query(sqlstring, (ingredient_id,))
+            if ret[0] != 0:
+                return -1, {'error_message': ret[1]}
+            self._commit_later()
         return 0, {}
 
     def retitle_recipe(self, recipe_id: int, new_title: str) -> tuple[int, dict]:
@@ -350,11 +1016,12 @@ class DBInterface:
                              set recipe_title = (?)
                              WHERE recipe_id = (?)
                          """
-        ret = self._execute_query(sqlstring, (new_title
-                                              , recipe_id))
-        if ret[0] != 0:
-            return -1, {'error_message': ret[1]}
-        self.db_connection.commit()
+        with self._editing():
+            ret = self._execute_query(sqlstring, (new_title
+                                                  , recipe_id))
+            if ret[0] != 0:
+                return -1, {'error_message': ret[1]}
+            self._commit_later()
         return 0, {}
 
     def update_notes(self, recipe_id: int, updated_notes: str) -> tuple[int, dict]:
@@ -362,10 +1029,11 @@ class DBInterface:
                              SET recipe_notes = (?)
                              WHERE recipe_id = (?)
                          """
-        ret = self._execute_query(sqlstring, (updated_notes, recipe_id))
-        if ret[0] != 0:
-            return -1, {'error_message': ret[1]}
-        self.db_connection.commit()
+        with self._editing():
+            ret = self._execute_query(sqlstring, (updated_notes, recipe_id))
+            if ret[0] != 0:
+                return -1, {'error_message': ret[1]}
+            self._commit_later()
         return 0, {}
 
     def update_ingredient(self, ingredient_dict: dict):
@@ -391,14 +1059,15 @@ class DBInterface:
                                 ,kroger_quantity = (?)
                             WHERE ingredient_id = (?)
                          """
-        ret = self._execute_query(sqlstring, (ingredient_name,
-                                              ingredient_quantity,
-                                              ingredient_unit_type,
-                                              kroger_upc,
-                                              kroger_quantity,
-                                              ingredient_id))
-        if ret[0] == 0:
-            self.db_connection.commit()
+        with self._editing():
+            ret = self._execute_query(sqlstring, (ingredient_name,
+                                                  ingredient_quantity,
+                                                  ingredient_unit_type,
+                                                  kroger_upc,
+                                                  kroger_quantity,
+                                                  ingredient_id))
+            if ret[0] == 0:
+                self._commit_later()
         return ret
 
     def new_recipe(self) -> tuple[int, dict]:
@@ -415,34 +1084,34 @@ class DBInterface:
                                 ('<New Recipe>'
                                 ,'<Recipe Notes>')
                          """
-        ret = self._execute_query(sqlstring)
-        if ret[0] != 0:
-            return -1, {'error_message': ret[1]}
-        recipe_id: int = self.db_cursor.lastrowid
-        sqlstring = f""" INSERT INTO recipe_ingredients 
-                        (ingredient_name
-                        ,ingredient_quantity
-                        ,ingredient_unit_type
-                        ,kroger_upc
-                        ,kroger_quantity
-                        ,recipe_id)
-                        VALUES 
-                        ('<Example Ingredient>'
-                        ,3
-                        ,'strips'
-                        ,'0000000000000'
-                        ,.25 
-                        ,?)
-                    """
-        ret = self._execute_query(sqlstring, (recipe_id,))
-        if ret[0] != 0:
-            return -1, {'error_message': ret[1]}
-        self.db_connection.commit()
+        with self._editing():
+            ret = self._execute_query(sqlstring)
+            if ret[0] != 0:
+                return -1, {'error_message': ret[1]}
+            recipe_id: int = self.db_cursor.lastrowid
+            sqlstring = f""" INSERT INTO recipe_ingredients 
+                            (ingredient_name
+                            ,ingredient_quantity
+                            ,ingredient_unit_type
+                            ,kroger_upc
+                            ,kroger_quantity
+                            ,recipe_id)
+                            VALUES 
+                            ('<Example Ingredient>'
+                            ,3
+                            ,'strips'
+                            ,'0000000000000'
+                            ,.25 
+                            ,?)
+                        """
+            ret = self._execute_query(sqlstring, (recipe_id,))
+            if ret[0] != 0:
+                return -1, {'error_message': ret[1]}
+            self._commit_later()
         # Getting new recipe
-        ret = self.get_recipes()
+        ret = self.get_recipe(recipe_id)
         if ret[0] != 0:
-            return -1, {'error_message': ret[1]}
-        desired_recipe: dict = ret[1][recipe_id]
-        return 0, desired_recipe
+            return -1, ret[1]
+        return 0, ret[1]
 
 
@@ -0,0 +1,247 @@
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import Logger
+
+
+class FakeKroger:
+    """
+        Stand-in for api.kroger.com, for measuring and regression testing Communicator locally.
+
+        Serves the authorize, token, product search, multi-ID product lookup, product-by-id and cart
+        endpoints from a generated catalog. authorize skips the login page and redirects straight to
+        redirect_uri with a code and the caller's state, for exercising RedirectListener. Every request can be slowed by latency (plus up to jitter seconds),
+        and fails with a 500 at error_rate or a 429 at throttle_rate. Point Communicator's api_base
+        at the api_base start() returns.
+    """
+
+    fulfillment_flags: tuple = ('inStore', 'curbside', 'delivery', 'shipToHome')
+
+    def __init__(self,
+                 host: str = 'localhost',
+                 port: int = 0,
+                 catalog_size: int = 1000,
+                 latency: float = .05,
+                 jitter: float = .02,
+                 error_rate: float = 0.0,
+                 throttle_rate: float = 0.0,
+                 retry_after: float = 1,
+                 reject_upcs: set = None,
+                 seed: int = 0):
+        """
+        :param port: 0 picks a free port
+        :param catalog_size: Products in the catalog. UPCs are zero padded indexes, see upc()
+        :param latency: Seconds added to every response
+        :param jitter: Up to this many more seconds, uniformly distributed
+        :param error_rate: Fraction of requests answered with a 500
+        :param throttle_rate: Fraction of requests answered with a 429
+        :param retry_after: Retry-After seconds sent with every 429
+        :param reject_upcs: UPCs the cart endpoint refuses with a 400
+        :param seed: Makes the catalog and the injected failures repeatable
+        """
+        self.host: str = host
+        self.port: int = port
+        self.latency: float = latency
+        self.jitter: float = jitter
+        self.error_rate: float = error_rate
+        self.throttle_rate: float = throttle_rate
+        self.retry_after: float = retry_after
+        self.reject_upcs: set = set(reject_upcs or ())
+        self._random: random.Random = random.Random(seed)
+        self.catalog: dict = {}
+        for index in range(catalog_size):
+            product: dict = self._product(index)
+            self.catalog[product['upc']] = product
+        self.cart: dict = {}  # {<upc>: <quantity>}
+        self.request_counts: dict = {}  # {<endpoint>: <requests served>}
+        self.issued_codes: list = []  # Authorization codes handed out by authorize, oldest first
+        self._lock: threading.Lock = threading.Lock()
+        self._server = None
+
+    @staticmethod
+    def upc(index: int) -> str:
+        return str(index).zfill(13)
+
+    def _product(self, index: int) -> dict:
+        """ Product json shaped like the products endpoint's """
+        words: tuple = ('onion', 'garlic', 'tomato', 'basil', 'rice', 'flour', 'butter', 'milk', 'egg', 'pepper')
+        brands: tuple = ('Kroger', 'Simple Truth', 'Private Selection', 'Heritage Farm')
+        regular: float = round(self._random.uniform(.5, 15), 2)
+        return {
+            'productId': self.upc(index),
+            'upc': self.upc(index),
+            'brand': brands[index % len(brands)],
+            'description': f'{words[index % len(words)].title()} {words[(index // len(words)) % len(words)]} #{index}',
+            'items': [{
+                'size': f'{index % 5 + 1} lb',
+                'soldBy': 'UNIT',
+                'price': {'regular': regular,
+                          'promo': round(regular * .8, 2) if index % 7 == 0 else 0},
+                'fulfillment': {flag: index % 11 != 0 for flag in self.fulfillment_flags},
+                'inventory': {'stockLevel': 'TEMPORARILY_OUT_OF_STOCK' if index % 13 == 0 else 'HIGH'}
+            }]
+        }
+
+    def _count(self, endpoint: str) -> None:
+        with self._lock:
+            self.request_counts[endpoint] = self.request_counts.get(endpoint, 0) + 1
+
+    def _injected_failure(self):
+        """ :return: None, or (status, body, headers) for a simulated failure """
+        with self._lock:
+            roll: float = self._random.random()
+        if roll < self.error_rate:
+            return 500, {'errors': {'reason': 'Simulated server error'}}, {}
+        if roll < self.error_rate + self.throttle_rate:
+            return 429, {'errors': {'reason': 'Simulated rate limit'}}, {'Retry-After': str(self.retry_after)}
+        return None
+
+    def _search(self, query: dict) -> tuple[int, dict]:
+        # filter.start runs 1 to 250, like the live endpoint. 1 is the first product
+        start: int = int(query.get('filter.start', ['1'])[0])
+        if not 1 <= start <= 250:
+            return 400, {'errors': {'reason': 'filter.start must be between 1 and 250'}}
+        start -= 1
+        limit: int = int(query.get('filter.limit', ['10'])[0])  # Paged like the real endpoint, 10 by default
+        ids: str = query.get('filter.productId', [''])[0]
+        if ids:
+            found: list = [self.catalog[upc] for upc in ids.split(',') if upc in self.catalog]
+            return 200, {'data': found[start:start + limit],
+                         'meta': {'pagination': {'start': start + 1, 'limit': limit, 'total': len(found)}}}
+        words: list = query.get('filter.term', [''])[0].lower().split()
+        matches: list = [product for product in self.catalog.values()
+                         if all(word in f"{product['description']} {product['brand']}".lower() for word in words)]
+        return 200, {'data': matches[start:start + limit],
+                     'meta': {'pagination': {'start': start + 1, 'limit': limit, 'total': len(matches)}}}
+
+    def _authorize(self, query: dict) -> tuple[int, dict, dict]:
+        """ :return: (status, body, headers). A 302 to redirect_uri carrying code and state """
+        redirect_uri: str = query.get('redirect_uri', [''])[0]
+        if not redirect_uri:
+            return 400, {'errors': {'reason': 'redirect_uri is required'}}, {}
+        with self._lock:
+            code: str = f'fake-code-{len(self.issued_codes)}'
+            self.issued_codes.append(code)
+        params: dict = {'code': code}
+        if 'state' in query:
+            params['state'] = query['state'][0]
+        return 302, {}, {'Location': f'{redirect_uri}?{urllib.parse.urlencode(params)}'}
+
+    def _add_to_cart(self, body: dict) -> tuple[int, dict]:
+        items: list = body.get('items', [])
+        rejected: list = [item['upc'] for item in items if item['upc'] in self.reject_upcs]
+        if rejected:
+            return 400, {'errors': {'reason': f'Invalid UPCs: {rejected}'}}
+        with self._lock:
+            for item in items:
+                self.cart[item['upc']] = self.cart.get(item['upc'], 0) + item['quantity']
+        return 204, {}
+
+    def _build_handler(self):
+        fake: FakeKroger = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Keep-alive, like the real API
+
+            def _respond(self, status: int, body: dict, headers: dict = None):
+                payload: bytes = json.dumps(body).encode() if status != 204 else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _handle(self, method: str):
+                parsed = urllib.parse.urlparse(self.path)
+                path: str = parsed.path.rstrip('/')
+                query: dict = urllib.parse.parse_qs(parsed.query)
+                length: int = int(self.headers.get('Content-Length', 0))
+                raw: bytes = self.rfile.read(length) if length else b''
+                if path.endswith('/connect/oauth2/authorize') and method == 'GET':
+                    endpoint = 'authorize'
+                elif path.endswith('/connect/oauth2/token') and method == 'POST':
+                    endpoint = 'token'
+                elif path.endswith('/products') and method == 'GET':
+                    endpoint = 'products'
+                elif '/products/' in path and method == 'GET':
+                    endpoint = 'product'
+                elif path.endswith('/cart/add') and method == 'PUT':
+                    endpoint = 'cart'
+                else:
+                    self._respond(404, {'errors': {'reason': f'No fake for {method} {parsed.path}'}})
+                    return
+                fake._count(endpoint)
+                time.sleep(fake.latency + random.uniform(0, fake.jitter))
+                failure = fake._injected_failure()
+                if failure is not None:
+                    self._respond(*failure)
+                    return
+                if endpoint == 'authorize':
+                    self._respond(*fake._authorize(query))
+                elif endpoint == 'token':
+                    self._respond(200, {'access_token': f'fake-access-{time.time()}',
+                                        'refresh_token': f'fake-refresh-{time.time()}',
+                                        'expires_in': 1800,
+                                        'token_type': 'bearer'})
+                elif endpoint == 'products':
+                    self._respond(*fake._search(query))
+                elif endpoint == 'product':
+                    product = fake.catalog.get(path.rsplit('/', 1)[-1])
+                    if product is None:
+                        self._respond(404, {'errors': {'reason': 'Product not found'}})
+                    else:
+                        self._respond(200, {'data': product})
+                else:
+                    try:
+                        body: dict = json.loads(raw or b'{}')
+                    except ValueError:
+                        self._respond(400, {'errors': {'reason': 'Malformed json'}})
+                        return
+                    self._respond(*fake._add_to_cart(body))
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+            def do_PUT(self):
+                self._handle('PUT')
+
+            def do_HEAD(self):
+                # Pre-connects and circuit breaker probes
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> tuple[int, dict]:
+        """ Serves from a background thread. :return: (0, {'api_base': <>}) or (-1, {'error_message': <>}) """
+        try:
+            self._server = ThreadingHTTPServer((self.host, self.port), self._build_handler())
+        except OSError as e:
+            Logger.Logger.log_error(f'Could not listen on {self.host}:{self.port} -- {e}')
+            return -1, {'error_message': f'Could not listen on {self.host}:{self.port}: {e}'}
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, args=(.05,), daemon=True).start()
+        return 0, {'api_base': f'http://{self.host}:{self.port}/v1/'}
+
+    def reset_counts(self) -> None:
+        with self._lock:
+            self.request_counts = {}
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
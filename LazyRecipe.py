@@ -0,0 +1,51 @@
+import copy
+from typing import Callable
+import Logger
+
+
+class RecipeLoadError(Exception):
+    """ A recipe's notes and ingredients couldn't be read from the database """
+
+
+class LazyRecipe(dict):
+    """
+        Recipe dict that starts out as just its header (recipe_id, recipe_title).
+
+        recipe_notes and ingredients are loaded from the database the first time either is
+        read with recipe[key], so startup only pays for titles. Methods that don't go through
+        __getitem__ (get, items, in, copy) only see what has been loaded so far.
+        A failed load raises RecipeLoadError. copy.deepcopy loads the recipe and returns a plain dict.
+    """
+
+    lazy_keys: tuple = ('recipe_notes', 'ingredients')
+
+    def __init__(self, recipe_id: int, recipe_title: str, loader: Callable[[int], tuple[int, dict]]):
+        """
+        :param loader: Takes a recipe_id, returns (0, <full recipe dict>) or an error, e.g. DBInterface.get_recipe
+        """
+        super().__init__(recipe_id=recipe_id, recipe_title=recipe_title)
+        self._loader = loader
+
+    @property
+    def hydrated(self) -> bool:
+        return all(dict.__contains__(self, key) for key in LazyRecipe.lazy_keys)
+
+    def __missing__(self, key):
+        if key not in LazyRecipe.lazy_keys or self.hydrated:
+            raise KeyError(key)
+        ret = self._loader(dict.__getitem__(self, 'recipe_id'))
+        if ret[0] != 0:
+            message: str = f"Error loading recipe {dict.__getitem__(self, 'recipe_id')} -- " + ret[1]['error_message']
+            Logger.Logger.log_error(message)
+            raise RecipeLoadError(message)
+        for lazy_key in LazyRecipe.lazy_keys:
+            # Anything set before the load (a fresh notes edit) wins
+            if not dict.__contains__(self, lazy_key):
+                dict.__setitem__(self, lazy_key, ret[1][lazy_key])
+        return dict.__getitem__(self, key)
+
+    def __deepcopy__(self, memo: dict) -> dict:
+        """ Copies the data only. The loader holds the DBInterface, which can't be copied """
+        if not self.hydrated:
+            self.__missing__(LazyRecipe.lazy_keys[0])
+        return copy.deepcopy(dict(self), memo)
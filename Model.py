@@ -1,4 +1,6 @@
+import sqlite3
 import DBInterface
+import LazyRecipe
 import Logger
 import copy
 
@@ -33,14 +35,20 @@ class Model:
 
     def _get_recipes(self) -> dict:
         """
-        Initialization fnx. Loads recipe data into the Model.
+        Initialization fnx. Loads every recipe's header into the Model.
+        Notes and ingredients are pulled per recipe on first use, see LazyRecipe.
         """
-        ret = self.db_interface.get_recipes()
-        if ret[0] != 0:
-            Logger.Logger.log_error(f'Error in model._get_recipes pulling recipes -- ' + ret[1]['error_message'])
-            print('Error in ._get_recipes -- ' + ret[1]['error_message'])
+        recipes: dict = {}
+        try:
+            for header in self.db_interface.iter_recipe_headers():
+                recipes[header['recipe_id']] = LazyRecipe.LazyRecipe(header['recipe_id'],
+                                                                     header['recipe_title'],
+                                                                     self.db_interface.get_recipe)
+        except sqlite3.Error as e:
+            Logger.Logger.log_error(f'Error in model._get_recipes pulling recipes -- {e}')
+            print(f'Error in ._get_recipes -- {e}')
             exit(1)
-        return ret[1]
+        return recipes
 
     def add_recipe(self, recipe: dict) -> tuple[int, dict]:
         """
@@ -84,15 +92,26 @@ class Model:
             self.selected_recipes.pop(recipe_id, 'NULL')
         return ret
 
-    def toggle_recipe(self, recipe_id: int) -> None:
+    def toggle_recipe(self, recipe_id: int) -> bool:
         """
         Selects or deselects the given recipe, toggling
         its selection for automatic shopping.
+        :return: True if the recipe is now selected
         """
         if recipe_id in self.selected_recipes:
             self.selected_recipes.pop(recipe_id)
-        else:
-            self.selected_recipes[recipe_id] = self.recipes[recipe_id]
+            return False
+        self.selected_recipes[recipe_id] = self.recipes[recipe_id]
+        return True
+
+    def recipe_upcs(self, recipe_id: int) -> list[str]:
+        """ The recipe's ingredient UPCs, ignoring the default (13 zeroes) """
+        upcs: list = []
+        for ingredient in self.recipes[recipe_id]['ingredients'].values():
+            kroger_upc: str = ingredient['kroger_upc']
+            if kroger_upc != '0000000000000' and kroger_upc not in upcs:
+                upcs.append(kroger_upc)
+        return upcs
 
     def desired_ingredients(self) -> list[dict]:
         """
@@ -135,6 +154,48 @@ class Model:
                 upc['quantity'] = int_quant
         return order_list
 
+    def cart_delta(self) -> tuple[int, list]:
+        """
+        What desired_ingredients still needs on top of what has already been pushed to
+        the cart since the last checkout. The API can't remove cart items, so only
+        positive differences are returned.
+        :return: (0, [{'upc': <str>, 'quantity': <int>}, ...])
+                 (-1, {'error_message': <>})
+        """
+        ret = self.db_interface.get_cart_journal()
+        if ret[0] != 0:
+            return ret
+        pushed: dict = ret[1]
+        delta: list = []
+        for item in self.desired_ingredients():
+            missing: int = item['quantity'] - pushed.get(item['upc'], 0)
+            if missing > 0:
+                delta.append({'upc': item['upc'], 'quantity': missing})
+        return 0, delta
+
+    def record_cart_push(self, items: list[dict]) -> tuple[int, dict]:
+        """ :param items: [{'upc': <str>, 'quantity': <int>}, ...] successfully added to the cart """
+        return self.db_interface.record_cart_push(items)
+
+    def reset_cart_journal(self) -> tuple[int, dict]:
+        """ Called once the cart has been checked out """
+        return self.db_interface.clear_cart_journal()
+
+    def ingredients_for_upcs(self, upcs: list[str]) -> dict:
+        """
+        Finds the selected recipe ingredients that reference each UPC
+        :return: {<upc>: ['<recipe_title>: <ingredient_name>', ...], ...}
+        """
+        wanted: set = set(upcs)
+        references: dict = {upc: [] for upc in upcs}
+        for recipe_id in self.selected_recipes:
+            recipe: dict = self.selected_recipes[recipe_id]
+            for ingredient in recipe['ingredients'].values():
+                if ingredient['kroger_upc'] in wanted:
+                    references[ingredient['kroger_upc']].append(
+                        f"{recipe['recipe_title']}: {ingredient['ingredient_name']}")
+        return references
+
     def add_ingredient(self, recipe_id: int, change_dict: dict) -> tuple[int, dict]:
         """
         Adds a new ingredient entry in the database.
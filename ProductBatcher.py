@@ -0,0 +1,93 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+import Logger
+import RequestScheduler
+
+
+class ProductBatcher:
+    """
+        Collects pending product lookups and packs them into multi-ID requests.
+
+        Callers submit() a UPC and get a Future back. Pending UPCs are sent either once
+        max_batch_size of them are waiting or max_delay seconds after the first one arrived,
+        whichever comes first. Each Future resolves to the usual (int, dict) pair.
+        A batch goes out at the most urgent priority of the lookups it carries.
+    """
+
+    def __init__(self,
+                 fetch_fnx: Callable[[list[str], int], tuple[int, dict]],
+                 max_batch_size: int = 50,
+                 max_delay: float = .02,
+                 max_workers: int = 4):
+        """
+        :param fetch_fnx: Takes a list of UPCs and a RequestScheduler priority,
+                          returns (0, {<upc>: <ProductRecord>}) or (-1, {'error_message': <>})
+        :param max_batch_size: Most UPCs a single request may carry
+        :param max_delay: Seconds to wait for more UPCs before sending a partial batch
+        :param max_workers: Batches in flight at once
+        """
+        self.fetch_fnx = fetch_fnx
+        self.max_batch_size: int = max_batch_size
+        self.max_delay: float = max_delay
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock: threading.Lock = threading.Lock()
+        self._pending: dict[str, list[Future]] = {}  # Keyed on UPC so duplicates share one slot
+        self._pending_priority: int = RequestScheduler.BACKGROUND
+        self._timer = None
+
+    def submit(self, upc: str, priority: int = RequestScheduler.INTERACTIVE) -> Future:
+        """ Queues a lookup. The Future resolves to (0, {'data': <product>}) or (-1, {'error_message': <>}) """
+        future: Future = Future()
+        batch: tuple = ()
+        with self._lock:
+            self._pending.setdefault(upc, []).append(future)
+            self._pending_priority = min(self._pending_priority, priority)
+            if len(self._pending) >= self.max_batch_size:
+                batch = self._take_pending()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.max_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if batch:
+            self._executor.submit(self._send_batch, *batch)
+        return future
+
+    def flush(self) -> None:
+        """ Sends whatever is pending without waiting out the delay """
+        with self._lock:
+            batch: tuple = self._take_pending()
+        if batch:
+            self._executor.submit(self._send_batch, *batch)
+
+    def _take_pending(self) -> tuple:
+        """
+        Caller must hold self._lock
+        :return: (pending lookups, their priority) or () if nothing is pending
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return ()
+        batch: tuple = (self._pending, self._pending_priority)
+        self._pending = {}
+        self._pending_priority = RequestScheduler.BACKGROUND
+        return batch
+
+    def _send_batch(self, batch: dict[str, list[Future]], priority: int) -> None:
+        """ Issues one multi-ID request and splits the response back out per UPC """
+        try:
+            ret = self.fetch_fnx(list(batch.keys()), priority)
+        except Exception as e:
+            Logger.Logger.log_error(f'Error fetching product batch: {e}')
+            ret = -1, {'error_message': f'Error fetching product batch: {e}'}
+        for upc, futures in batch.items():
+            if ret[0] != 0:
+                result = ret
+            elif upc in ret[1]:
+                result = 0, {'data': ret[1][upc]}
+            else:
+                result = -1, {'error_message': f'No product found for {upc}'}
+            for future in futures:
+                future.set_result(result)
@@ -0,0 +1,146 @@
+import datetime
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable
+import DBInterface
+import Logger
+import ProductRecord
+import RequestScheduler
+
+
+class ProductCache:
+    """
+        Read-through cache for product lookups keyed on (upc, location_id).
+
+        Lookups check an in-process LRU first, then the product_cache table, and only then
+        go to the API. Concurrent misses for the same product share one in-flight fetch.
+        Failed lookups are never cached. Products are held as compact ProductRecords.
+        Stale entries are kept until evicted so they can still be served while offline.
+    """
+
+    def __init__(self,
+                 db_interface: DBInterface,
+                 submit_fnx: Callable[[str, str, int], Future],
+                 flush_fnx: Callable[[], None],
+                 ttl: float = 24 * 60 * 60,
+                 lru_size: int = 512):
+        """
+        :param submit_fnx: Queues a network lookup given (upc, location_id, priority)
+        :param flush_fnx: Sends queued lookups immediately
+        :param ttl: Seconds a cached product stays fresh
+        :param lru_size: Products held in memory
+        """
+        self.db_interface: DBInterface = db_interface
+        self.submit_fnx = submit_fnx
+        self.flush_fnx = flush_fnx
+        self.ttl: float = ttl
+        self.lru_size: int = lru_size
+        self._lru: OrderedDict = OrderedDict()  # {(upc, location_id): (ProductRecord, timestamp)}
+        self._inflight: dict[tuple, Future] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+    def _fresh(self, timestamp: float, max_age: float = None) -> bool:
+        now: float = datetime.datetime.now().timestamp()
+        if max_age is not None and (now - timestamp) >= max_age:
+            return False
+        return (now - timestamp) < self.ttl
+
+    def _lru_get(self, key: tuple, max_age: float = None, stale_ok: bool = False):
+        """ Caller must hold self._lock """
+        entry = self._lru.get(key)
+        if entry is None:
+            return None
+        if not stale_ok and not self._fresh(entry[1], max_age):
+            return None
+        self._lru.move_to_end(key)
+        return entry[0]
+
+    def _lru_put(self, key: tuple, product: ProductRecord.ProductRecord, timestamp: float) -> None:
+        """ Caller must hold self._lock """
+        self._lru[key] = (product, timestamp)
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def _db_get(self, key: tuple, max_age: float = None, stale_ok: bool = False):
+        ret = self.db_interface.retrieve_cached_product(*key)
+        if ret[0] == -1:
+            Logger.Logger.log_error(f'Error reading product cache for {key} -- ' + ret[1][0])
+            return None
+        if ret[0] == 1 or not (stale_ok or self._fresh(ret[1][1], max_age)):
+            return None
+        product = ProductRecord.ProductRecord.from_dict(json.loads(ret[1][0]))
+        with self._lock:
+            self._lru_put(key, product, ret[1][1])
+        return product
+
+    def _store(self, key: tuple, shared: Future, fetched: Future) -> None:
+        """ Done-callback for a network lookup. Caches successes and releases any waiters. """
+        try:
+            ret = fetched.result()
+        except Exception as e:
+            ret = -1, {'error_message': f'Error retrieving product {key[0]}: {e}'}
+        if ret[0] == 0:
+            product: ProductRecord.ProductRecord = ret[1]['data']
+            timestamp: float = datetime.datetime.now().timestamp()
+            with self._lock:
+                self._lru_put(key, product, timestamp)
+            db_ret = self.db_interface.cache_product(key[0], key[1], json.dumps(product.to_dict()), timestamp)
+            if db_ret[0] != 0:
+                Logger.Logger.log_error(f'Error caching product {key[0]} -- ' + db_ret[1])
+        with self._lock:
+            self._inflight.pop(key, None)
+        shared.set_result(ret)
+
+    def get_many(self,
+                 upcs: list[str],
+                 location_id: str,
+                 priority: int = RequestScheduler.INTERACTIVE,
+                 max_age: float = None,
+                 stale_ok: bool = False) -> list[tuple[int, dict]]:
+        """
+        :param priority: Priority for any network lookups, see RequestScheduler
+        :param max_age: Seconds. Cached products older than this are refetched even if within the ttl
+        :param stale_ok: Serve cached products of any age, only going to the network on a miss
+        :return: [(0, {'data': <ProductRecord>}) or (-1, {'error_message': <>}), ...] in upcs order
+        """
+        results: list = [None] * len(upcs)
+        waiting: dict[int, Future] = {}
+        submitted: int = 0
+        for index, upc in enumerate(upcs):
+            key: tuple = (upc, location_id)
+            with self._lock:
+                product = self._lru_get(key, max_age, stale_ok)
+            if product is None:
+                product = self._db_get(key, max_age, stale_ok)
+            if product is not None:
+                results[index] = 0, {'data': product}
+                continue
+            # Cache miss. Joining an in-flight fetch if one exists
+            with self._lock:
+                shared: Future = self._inflight.get(key)
+                owner: bool = shared is None
+                if owner:
+                    shared = Future()
+                    self._inflight[key] = shared
+            if owner:
+                fetched: Future = self.submit_fnx(upc, location_id, priority)
+                fetched.add_done_callback(lambda f, k=key, s=shared: self._store(k, s, f))
+                submitted += 1
+            waiting[index] = shared
+        # A bulk call has gathered its batch already. A lone lookup waits out the batcher's
+        # delay so concurrent callers' lookups go out together
+        if submitted > 1:
+            self.flush_fnx()
+        for index, shared in waiting.items():
+            results[index] = shared.result()
+        return results
+
+    def get(self,
+            upc: str,
+            location_id: str,
+            priority: int = RequestScheduler.INTERACTIVE,
+            stale_ok: bool = False) -> tuple[int, dict]:
+        return self.get_many([upc], location_id, priority, stale_ok=stale_ok)[0]
@@ -0,0 +1,101 @@
+import sys
+
+
+class ProductRecord:
+    """
+        Compact stand-in for a Kroger product response.
+
+        Keeps only the fields the app uses. Values that repeat across thousands of products
+        (brand, size, sold-by, stock level) are interned so every record shares one copy.
+    """
+
+    __slots__ = ('upc',
+                 'description',
+                 'brand',
+                 'size',
+                 'sold_by',
+                 'regular_price',
+                 'promo_price',
+                 'fulfillment',
+                 'stock_level')
+
+    # Bit per fulfillment method, keyed on the flags Kroger uses in product responses
+    fulfillment_bits: dict = {
+        'inStore': 1,
+        'curbside': 2,
+        'delivery': 4,
+        'shipToHome': 8
+    }
+
+    def __init__(self,
+                 upc: str,
+                 description: str,
+                 brand: str = '',
+                 size: str = '',
+                 sold_by: str = '',
+                 regular_price: float = None,
+                 promo_price: float = None,
+                 fulfillment: int = 0,
+                 stock_level: str = ''):
+        self.upc: str = upc
+        self.description: str = description
+        self.brand: str = sys.intern(brand)
+        self.size: str = sys.intern(size)
+        self.sold_by: str = sys.intern(sold_by)
+        self.regular_price: float = regular_price
+        self.promo_price: float = promo_price
+        self.fulfillment: int = fulfillment
+        self.stock_level: str = sys.intern(stock_level)
+
+    @classmethod
+    def from_json(cls, product: dict) -> 'ProductRecord':
+        """ Projects a product from the products endpoint down to a record """
+        items: list = product.get('items') or [{}]
+        item: dict = items[0]
+        price: dict = item.get('price', {})
+        fulfillment: int = 0
+        for flag, bit in cls.fulfillment_bits.items():
+            if item.get('fulfillment', {}).get(flag, False):
+                fulfillment |= bit
+        return cls(upc=product.get('upc') or product.get('productId', ''),
+                   description=product.get('description', ''),
+                   brand=product.get('brand', ''),
+                   size=item.get('size', ''),
+                   sold_by=item.get('soldBy', ''),
+                   regular_price=price.get('regular') or None,
+                   promo_price=price.get('promo') or None,
+                   fulfillment=fulfillment,
+                   stock_level=item.get('inventory', {}).get('stockLevel', ''))
+
+    def to_dict(self) -> dict:
+        """ For persisting in the cache tables """
+        return {slot: getattr(self, slot) for slot in ProductRecord.__slots__}
+
+    @classmethod
+    def from_dict(cls, record: dict) -> 'ProductRecord':
+        """ Inverse of to_dict. Raw product json cached before records existed is projected instead. """
+        if 'productId' in record:
+            return cls.from_json(record)
+        return cls(**record)
+
+    @property
+    def price(self):
+        """ Current unit price, promo when there is one. None when the store has no price. """
+        return self.promo_price or self.regular_price
+
+    def available(self, fulfillment_flag: str) -> tuple[bool, str]:
+        """
+        Whether the product can be ordered through the given fulfillment method
+        :param fulfillment_flag: Key of fulfillment_bits
+        :return: (True, '') or (False, <reason>)
+        """
+        if self.price is None and not self.fulfillment:
+            return False, 'Not sold at this location'
+        if not self.fulfillment & ProductRecord.fulfillment_bits.get(fulfillment_flag, 0):
+            return False, f'Not available for {fulfillment_flag}'
+        if self.stock_level == 'TEMPORARILY_OUT_OF_STOCK':
+            return False, 'Temporarily out of stock'
+        return True, ''
+
+    def __repr__(self) -> str:
+        return f'ProductRecord({self.upc}, {self.description!r}, {self.price})'
@@ -0,0 +1,49 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """
+        Token bucket shared by every Communicator request.
+
+        Allows bursts of up to `burst` requests, refilling at `rate` requests per second.
+        pause() holds every caller back, e.g. while the API is telling us to slow down.
+    """
+
+    def __init__(self, rate: float = 10, burst: int = 10):
+        """
+        :param rate: Sustained requests per second
+        :param burst: Most requests that may go out back to back
+        """
+        self.rate: float = rate
+        self.burst: int = burst
+        self._tokens: float = burst
+        self._last_refill: float = time.monotonic()
+        self._resume_at: float = 0.0
+        self._lock: threading.Lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        """ Caller must hold self._lock """
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def acquire(self) -> None:
+        """ Blocks until a request may be sent """
+        while True:
+            with self._lock:
+                now: float = time.monotonic()
+                self._refill(now)
+                if now < self._resume_at:
+                    wait: float = self._resume_at - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                else:
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """ Holds all callers for at least the given number of seconds """
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+            self._tokens = 0
@@ -0,0 +1,85 @@
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import Logger
+
+
+class RedirectListener:
+    """
+        Tiny HTTP server on the app's redirect_uri that catches the OAuth redirect.
+
+        The authorization code is captured the moment the browser lands on the redirect,
+        so the token exchange can start right away instead of after a fixed sleep.
+    """
+
+    def __init__(self, redirect_uri: str, expected_state: str = None):
+        """
+        :param redirect_uri: e.g. http://localhost:8000
+        :param expected_state: Redirects carrying any other state value are rejected
+        """
+        parsed = urllib.parse.urlparse(redirect_uri)
+        self.host: str = parsed.hostname
+        self.port: int = parsed.port or 80
+        self.expected_state: str = expected_state
+        self.authorization_code: str = ''
+        self.error_message: str = ''
+        self._received: threading.Event = threading.Event()
+        self._server = None
+
+    def _build_handler(self):
+        listener: RedirectListener = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query: dict = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+                code: str = query.get('code', [''])[0]
+                state: str = query.get('state', [''])[0]
+                if not code:
+                    # Favicon requests and the like. Keep waiting for the real redirect
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                if listener.expected_state is not None and state != listener.expected_state:
+                    listener.error_message = f'Unexpected state in redirect: {state}'
+                else:
+                    listener.authorization_code = code
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html')
+                self.end_headers()
+                self.wfile.write(b'<html><body>Authorization received. This window can be closed.</body></html>')
+                listener._received.set()
+
+            def log_message(self, format, *args):
+                # Keeping the redirect out of stderr
+                pass
+
+        return Handler
+
+    def start(self) -> tuple[int, dict]:
+        """ Begins listening in a background thread. Must be called before the browser is sent to authorize. """
+        try:
+            self._server = HTTPServer((self.host, self.port), self._build_handler())
+        except OSError as e:
+            Logger.Logger.log_error(f'Could not listen on {self.host}:{self.port} -- {e}')
+            return -1, {'error_message': f'Could not listen on {self.host}:{self.port}: {e}'}
+        threading.Thread(target=self._server.serve_forever, args=(.05,), daemon=True).start()
+        return 0, {'success_message': f'Listening on {self.host}:{self.port}'}
+
+    def wait_for_code(self, timeout: float = 60) -> tuple[int, dict]:
+        """
+        Blocks until the redirect arrives or timeout seconds pass. Stops the listener either way.
+        :return: (0, {'authorization_code': <>}) or (-1, {'error_message': <>})
+        """
+        received: bool = self._received.wait(timeout)
+        self.stop()
+        if not received:
+            return -1, {'error_message': f'No authorization redirect within {timeout} seconds'}
+        if not self.authorization_code:
+            return -1, {'error_message': self.error_message}
+        return 0, {'authorization_code': self.authorization_code}
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
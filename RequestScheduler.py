@@ -0,0 +1,114 @@
+import datetime
+import threading
+import DBInterface
+import Logger
+import RateLimiter
+
+# Request priorities. Lower values are served first
+INTERACTIVE: int = 0
+BACKGROUND: int = 1
+
+
+class QuotaExceeded(Exception):
+    """ Raised when a request is refused to protect the endpoint's daily quota """
+
+
+class RequestScheduler:
+    """
+        Gatekeeper in front of every Communicator request.
+
+        Keeps per-endpoint daily call counts in the api_quota table and hands out rate limiter
+        slots by priority: background work (prefetching, price refreshes) waits while any
+        interactive call is queued, and is dropped outright once an endpoint's remaining quota
+        falls into the share reserved for interactive calls.
+    """
+
+    # Kroger's published per-day limits. None means unmetered
+    default_daily_limits: dict = {
+        'products': 10000,
+        'cart': 5000,
+        'token': None
+    }
+
+    def __init__(self,
+                 db_interface: DBInterface,
+                 rate_limiter: RateLimiter.RateLimiter,
+                 daily_limits: dict = None,
+                 background_reserve: float = .2):
+        """
+        :param daily_limits: {<endpoint>: <calls per day> or None}. Defaults to default_daily_limits
+        :param background_reserve: Fraction of each daily quota background calls may not touch
+        """
+        self.db_interface: DBInterface = db_interface
+        self.rate_limiter: RateLimiter.RateLimiter = rate_limiter
+        self.daily_limits: dict = dict(RequestScheduler.default_daily_limits)
+        if daily_limits is not None:
+            self.daily_limits.update(daily_limits)
+        self.background_reserve: float = background_reserve
+        self._day: str = ''
+        self._counts: dict = {}
+        self._waiting: dict = {INTERACTIVE: 0, BACKGROUND: 0}
+        self._condition: threading.Condition = threading.Condition()
+
+    @staticmethod
+    def _today() -> str:
+        """ Kroger's quotas roll over on UTC days """
+        return datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+
+    def _load_counts(self) -> None:
+        """ Caller must hold self._condition. Picks up today's counts from the database on day rollover. """
+        today: str = self._today()
+        if today == self._day:
+            return
+        self._day = today
+        ret = self.db_interface.retrieve_quota_counts(today)
+        if ret[0] != 0:
+            Logger.Logger.log_error('Error reading API quota counts -- ' + ret[1]['error_message'])
+            self._counts = {}
+        else:
+            self._counts = ret[1]
+
+    def remaining(self, endpoint: str):
+        """ Calls left today for the endpoint, or None if it is unmetered """
+        with self._condition:
+            self._load_counts()
+            limit = self.daily_limits.get(endpoint)
+            if limit is None:
+                return None
+            return max(0, limit - self._counts.get(endpoint, 0))
+
+    def _allowance(self, endpoint: str, priority: int):
+        """ Most calls the priority class may have made today, or None if unlimited """
+        limit = self.daily_limits.get(endpoint)
+        if limit is None:
+            return None
+        if priority == BACKGROUND:
+            return int(limit * (1 - self.background_reserve))
+        return limit
+
+    def admit(self, endpoint: str, priority: int = INTERACTIVE) -> None:
+        """
+        Counts the call against the endpoint's quota, then blocks until it may go out.
+        :raises QuotaExceeded: The call would eat into quota its priority isn't entitled to
+        """
+        with self._condition:
+            self._load_counts()
+            allowance = self._allowance(endpoint, priority)
+            if allowance is not None and self._counts.get(endpoint, 0) >= allowance:
+                raise QuotaExceeded(f'Daily quota for {endpoint} exhausted for priority {priority} calls')
+            # Counting the call on admission so concurrent callers can't overshoot the quota
+            self._counts[endpoint] = self._counts.get(endpoint, 0) + 1
+            day: str = self._day
+            self._waiting[priority] += 1
+            # Background work defers to anything interactive that is queued
+            while priority == BACKGROUND and self._waiting[INTERACTIVE] > 0:
+                self._condition.wait()
+        try:
+            self.rate_limiter.acquire()
+        finally:
+            with self._condition:
+                self._waiting[priority] -= 1
+                self._condition.notify_all()
+        ret = self.db_interface.increment_quota(day, endpoint)
+        if ret[0] != 0:
+            Logger.Logger.log_error(f'Error recording call to {endpoint} -- ' + ret[1])
@@ -0,0 +1,129 @@
+import datetime
+import json
+import re
+import threading
+from collections import OrderedDict
+import DBInterface
+import Logger
+import ProductRecord
+
+
+class SearchCache:
+    """
+        LRU + TTL cache of product search results, persisted in the search_cache table.
+        Entries are per store and per fulfillment mode (filter.fulfillment), since both change the results.
+
+        Terms are normalized (case and whitespace) before lookup. A search the cache hasn't
+        seen can still be answered locally when a cached broader term already holds Kroger's
+        complete result set and the new term only appends whole words to it ("tomato" -> "tomato paste",
+        never "egg" -> "eggplant"): those results are filtered down instead.
+        Stale entries can still be read while offline.
+    """
+
+    def __init__(self, db_interface: DBInterface, ttl: float = 24 * 60 * 60, lru_size: int = 256):
+        """
+        :param ttl: Seconds a cached search stays fresh
+        :param lru_size: Searches held in memory
+        """
+        self.db_interface: DBInterface = db_interface
+        self.ttl: float = ttl
+        self.lru_size: int = lru_size
+        # {(term, location_id, fulfillment): {'result_limit': int, 'results': list, 'complete': bool, 'timestamp': float}}
+        self._lru: OrderedDict = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+
+    @staticmethod
+    def normalize(term: str) -> str:
+        return ' '.join(term.lower().split())
+
+    @staticmethod
+    def _matches(product: ProductRecord.ProductRecord, term: str) -> bool:
+        """ Every word of the refined term must show up as a whole word in the product's description or brand """
+        haystack: str = f'{product.description} {product.brand}'.lower()
+        return all(re.search(rf'(?<!\w){re.escape(word)}(?!\w)', haystack) for word in term.split())
+
+    def _fresh(self, entry: dict) -> bool:
+        now: float = datetime.datetime.now().timestamp()
+        return (now - entry['timestamp']) < self.ttl
+
+    def _load(self, terms: list[str], location_id: str, fulfillment: str, stale_ok: bool = False) -> dict:
+        """
+        Fresh entries (any entries if stale_ok) for the given terms, from memory or the database.
+        :return: {<term>: <entry>}
+        """
+        found: dict = {}
+        missing: list = []
+        with self._lock:
+            for term in terms:
+                key: tuple = (term, location_id, fulfillment)
+                entry = self._lru.get(key)
+                if entry is not None and (stale_ok or self._fresh(entry)):
+                    self._lru.move_to_end(key)
+                    found[term] = entry
+                else:
+                    missing.append(term)
+        ret = self.db_interface.retrieve_cached_searches(missing, location_id, fulfillment)
+        if ret[0] != 0:
+            Logger.Logger.log_error('Error reading search cache -- ' + ret[1][0])
+            return found
+        for row in ret[1]:
+            entry: dict = {
+                'result_limit': row['result_limit'],
+                'results': [ProductRecord.ProductRecord.from_dict(product)
+                            for product in json.loads(row['results_json'])],
+                'complete': bool(row['complete']),
+                'timestamp': row['timestamp']
+            }
+            if stale_ok or self._fresh(entry):
+                found[row['term']] = entry
+                with self._lock:
+                    self._lru_put((row['term'], location_id, fulfillment), entry)
+        return found
+
+    def _lru_put(self, key: tuple, entry: dict) -> None:
+        """ Caller must hold self._lock """
+        self._lru[key] = entry
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def get(self, term: str, location_id: str, fulfillment: str, limit: int, stale_ok: bool = False):
+        """
+        :param stale_ok: Answer from entries past the ttl too
+        :return: [<ProductRecord>, ...] or None on a cache miss
+        """
+        term = self.normalize(term)
+        # Exact term first, then any broader term it refines by appending whole words
+        words: list = term.split()
+        broader_terms: list = [' '.join(words[:end]) for end in range(len(words) - 1, 0, -1)]
+        candidates: list = [term] + [broader for broader in broader_terms if len(broader) >= 3]
+        entries: dict = self._load(candidates, location_id, fulfillment, stale_ok)
+        exact = entries.get(term)
+        if exact is not None and (exact['complete'] or exact['result_limit'] >= limit):
+            return exact['results'][:limit]
+        for broader in candidates[1:]:
+            entry = entries.get(broader)
+            if entry is not None and entry['complete']:
+                refined: list = [product for product in entry['results'] if self._matches(product, term)]
+                return refined[:limit]
+        return None
+
+    def put(self, term: str, location_id: str, fulfillment: str, limit: int, results: list, complete: bool) -> None:
+        """
+        :param limit: The limit the search was made with
+        :param complete: True when results holds every match for the term
+        """
+        term = self.normalize(term)
+        entry: dict = {
+            'result_limit': limit,
+            'results': results,
+            'complete': complete,
+            'timestamp': datetime.datetime.now().timestamp()
+        }
+        with self._lock:
+            self._lru_put((term, location_id, fulfillment), entry)
+        results_json: str = json.dumps([product.to_dict() for product in results])
+        ret = self.db_interface.cache_search(term, location_id, fulfillment, limit, results_json,
+                                             complete, entry['timestamp'])
+        if ret[0] != 0:
+            Logger.Logger.log_error(f'Error caching search {term} -- ' + ret[1])
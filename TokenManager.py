@@ -0,0 +1,152 @@
+import datetime
+import threading
+from concurrent.futures import Future
+from typing import Callable
+import DBInterface
+import Logger
+
+
+class TokenManager:
+    """
+        Owns the access/refresh token pair.
+
+        Access tokens are refreshed in the background shortly before they expire, so requests
+        rarely wait on a refresh. When one does have to wait, every concurrent caller shares the
+        same in-flight refresh and the rotated refresh token is written to the database once.
+    """
+
+    def __init__(self,
+                 db_interface: DBInterface,
+                 exchange_fnx: Callable[[str], tuple[int, dict]],
+                 access_lifetime: float = 25 * 60,
+                 refresh_lead: float = 2 * 60):
+        """
+        :param exchange_fnx: Trades a refresh token for new tokens.
+                             Returns (0, {'access_token': <>, 'refresh_token': <>}) or (-1, {'error_message': <>})
+        :param access_lifetime: Seconds an access token is treated as valid (Kroger's are good for 30 minutes)
+        :param refresh_lead: Seconds before access_lifetime runs out to refresh in the background
+        """
+        self.db_interface: DBInterface = db_interface
+        self.exchange_fnx = exchange_fnx
+        self.access_lifetime: float = access_lifetime
+        self.refresh_lead: float = refresh_lead
+        self.access_token: str = ''
+        self.access_timestamp: float = 0.0
+        self.refresh_token: str = ''
+        self.refresh_timestamp: float = 0.0
+        self._lock: threading.Lock = threading.Lock()
+        self._inflight = None  # Future of the refresh in progress
+        self._timer = None
+
+    def set_tokens(self,
+                   access_token: str,
+                   access_timestamp: float,
+                   refresh_token: str,
+                   refresh_timestamp: float) -> None:
+        """ Adopts a token pair obtained elsewhere and schedules its proactive refresh """
+        with self._lock:
+            self.access_token = access_token
+            self.access_timestamp = access_timestamp
+            self.refresh_token = refresh_token
+            self.refresh_timestamp = refresh_timestamp
+        self._schedule_refresh()
+
+    def tokens(self) -> dict:
+        """ :return: {'access_token': <>, 'access_timestamp': <>, 'refresh_token': <>, 'refresh_timestamp': <>} """
+        with self._lock:
+            return {
+                'access_token': self.access_token,
+                'access_timestamp': self.access_timestamp,
+                'refresh_token': self.refresh_token,
+                'refresh_timestamp': self.refresh_timestamp
+            }
+
+    def access_fresh(self, access_timestamp: float) -> bool:
+        now: float = datetime.datetime.now().timestamp()
+        return (now - access_timestamp) < self.access_lifetime
+
+    def get_access_token(self) -> str:
+        """ A valid access token, waiting on a refresh only if the current one has expired """
+        with self._lock:
+            access_token: str = self.access_token
+            access_timestamp: float = self.access_timestamp
+        if self.access_fresh(access_timestamp):
+            return access_token
+        self.refresh(stale_timestamp=access_timestamp)
+        with self._lock:
+            return self.access_token
+
+    def refresh(self, stale_timestamp: float = None) -> tuple[int, dict]:
+        """
+        Exchanges the refresh token for a new pair. Callers arriving while a refresh is
+        already running wait for and share its outcome.
+        :param stale_timestamp: Skip the refresh if the access token has changed since this timestamp was read
+        :return: (0, {'success_message': <>}) or (-1, {'error_message': <>})
+        """
+        with self._lock:
+            if stale_timestamp is not None and self.access_timestamp != stale_timestamp:
+                return 0, {'success_message': 'Access token already refreshed'}
+            shared = self._inflight
+            owner: bool = shared is None
+            if owner:
+                shared = Future()
+                self._inflight = shared
+                refresh_token: str = self.refresh_token
+        if not owner:
+            return shared.result()
+        try:
+            ret = self._exchange(refresh_token)
+        except Exception as e:
+            ret = -1, {'error_message': f'Error refreshing tokens: {e}'}
+        with self._lock:
+            self._inflight = None
+        shared.set_result(ret)
+        if ret[0] == 0:
+            self._schedule_refresh()
+        return ret
+
+    def _exchange(self, refresh_token: str) -> tuple[int, dict]:
+        """ Only ever run by the one caller that owns the in-flight refresh """
+        ret = self.exchange_fnx(refresh_token)
+        if ret[0] != 0:
+            Logger.Logger.log_error('Failed to refresh tokens -- ' + ret[1]['error_message'])
+            return ret
+        timestamp: float = datetime.datetime.now().timestamp()
+        with self._lock:
+            self.access_token = ret[1]['access_token']
+            self.access_timestamp = timestamp
+            self.refresh_token = ret[1]['refresh_token']
+            self.refresh_timestamp = timestamp
+        db_ret = self.db_interface.update_token(ret[1]['refresh_token'], timestamp,
+                                                ret[1]['access_token'], timestamp)
+        if db_ret[0] != 0:
+            Logger.Logger.log_error('Error writing new refresh token to DB ' + db_ret[1])
+            Logger.Logger.log_error('Refresh token is:' + ret[1]['refresh_token'])
+            return -1, {'error_message': 'Error writing new refresh token to DB ' + db_ret[1]}
+        return 0, {'success_message': 'Refreshed tokens'}
+
+    def _schedule_refresh(self) -> None:
+        """ (Re)arms the background refresh to fire refresh_lead seconds before expiry """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            if not self.refresh_token:
+                self._timer = None
+                return
+            now: float = datetime.datetime.now().timestamp()
+            delay: float = self.access_timestamp + self.access_lifetime - self.refresh_lead - now
+            self._timer = threading.Timer(max(delay, 0.0), self._background_refresh)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _background_refresh(self) -> None:
+        with self._lock:
+            access_timestamp: float = self.access_timestamp
+        self.refresh(stale_timestamp=access_timestamp)
+
+    def stop(self) -> None:
+        """ Cancels the scheduled background refresh """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
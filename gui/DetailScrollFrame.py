@@ -7,27 +7,21 @@ class DetailScrollFrame(ScrollFrame):
 
     def __init__(self, parent: Tk, column: int, row: int, recipes: dict, **kwargs):
         ScrollFrame.__init__(self, parent, column, row, **kwargs)
-        self.detail_frames: dict = self._build_detail_frames(recipes)
+        self.recipes: dict = recipes
+        self.detail_frames: dict = {}  # Built on first view, so unviewed recipes are never loaded
         self.visible_frame = None  # The active DetailFrame
         # Binding mousewheel scrolling
         self.bind('<Enter>', lambda evnt: evnt.widget.bind('<MouseWheel>', self.on_mousewheel))
         self.bind('<Leave>', lambda evnt: evnt.widget.unbind_all('<MouseWheel>'))
 
-    def _build_detail_frames(self, recipes: dict) -> dict:
-        """ Returns a dict whose {K,V} are recipe_id and detail frames. """
-        frame_dict: dict = {}
-        for recipe_id in recipes.keys():
-            recipe: dict = recipes[recipe_id]
-            new_detailframe = DetailFrame(self.canvas_frame,
-                                          self,
-                                          recipe)
-            frame_dict[recipe_id] = new_detailframe
-        return frame_dict
-
     def make_visible(self, recipe_id):
         if self.visible_frame is not None:
             # Turn off
             self.visible_frame.toggle_visibility()
+        if recipe_id not in self.detail_frames:
+            self.detail_frames[recipe_id] = DetailFrame(self.canvas_frame,
+                                                        self,
+                                                        self.recipes[recipe_id])
         # Turning on
         self.visible_frame = self.detail_frames[recipe_id]
         self.visible_frame.toggle_visibility()
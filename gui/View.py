@@ -1,5 +1,6 @@
 from tkinter import *
 import Controller
+import LazyRecipe
 from gui.SelectionScrollFrame import SelectionScrollFrame
 from gui.DetailScrollFrame import DetailScrollFrame
 from gui.errormsg import error_message
@@ -16,6 +17,8 @@ class View(Tk):
         self.SelectionScrollFrame = SelectionScrollFrame(self, 0, 0, recipes)
         self.DetailScrollFrame: DetailScrollFrame = DetailScrollFrame(self, 1, 0, recipes)
         self._build_menubuttons()
+        self._poll_connection()
+        self.protocol('WM_DELETE_WINDOW', self._quit)
         self.mainloop()
 
     def _build_menubuttons(self):
@@ -24,6 +27,25 @@ class View(Tk):
         mn.add_command(label='New Recipe', command=self._new_recipe)
         mn.add_command(label='Delete Recipe', command=self._delete_confirmation)
         mn.add_command(label='Load Cart', command=self._load_cart)
+        mn.add_command(label='Compare Stores', command=self._compare_stores)
+        mn.add_command(label='Checked Out', command=self._checked_out)
+
+    def report_callback_exception(self, exc, val, tb):
+        """ Recipes that fail to load are reported in a popup rather than only on the console """
+        if isinstance(val, LazyRecipe.RecipeLoadError):
+            error_message(str(val))
+            return
+        super().report_callback_exception(exc, val, tb)
+
+    def _quit(self):
+        # Pending recipe edits are written before the window goes away
+        self.controller.shutdown()
+        self.destroy()
+
+    def _poll_connection(self):
+        """ Flags offline mode in the title bar. Polled, since the circuit breaker changes state off the Tk thread """
+        self.title('Autoshopper (offline)' if self.controller.offline() else 'Autoshopper')
+        self.after(2000, self._poll_connection)
 
     def _new_recipe(self):
         # Requesting new recipe from the controller
@@ -66,8 +88,39 @@ class View(Tk):
     def update_detail_frame(self, recipe_id):
         self.DetailScrollFrame.make_visible(recipe_id)
 
-    def _load_cart(self):
-        ret = self.controller.load_cart()
+    def _load_cart(self, force: bool = False):
+        ret = self.controller.load_cart(force)
+        if ret[0] != 0 and 'unavailable' in ret[1]:
+            self._unavailable_confirmation(ret[1]['error_message'])
+        elif ret[0] != 0:
+            error_message(ret[1]['error_message'])
+
+    def _unavailable_confirmation(self, report: str):
+        """ Lets the user load the available items anyway, or back out to fix the recipes """
+        new_window: Toplevel = Toplevel(height=300, width=300)
+        report_label: Label = Label(new_window, text=report + '\n\nLoad the remaining items anyway?')
+        report_label.grid(column=0, row=0, columnspan=2)
+        ok_button: Button = Button(new_window, text='Load Anyway',
+                                   command=lambda: (new_window.destroy(), self._load_cart(force=True)))
+        ok_button.grid(column=0, row=1)
+        cancel_button: Button = Button(new_window, text='Cancel', command=lambda: new_window.destroy())
+        cancel_button.grid(column=1, row=1)
+
+    def _compare_stores(self):
+        ret = self.controller.compare_stores()
+        if ret[0] != 0:
+            error_message(ret[1]['error_message'])
+            return
+        lines: list = ['Offline -- using cached prices'] if ret[1]['offline'] else []
+        for location_id, summary in ret[1]['totals'].items():
+            line: str = f"Store {location_id}: ${summary['total']:.2f}"
+            if summary['missing']:
+                line += f" ({len(summary['missing'])} items unpriced)"
+            lines.append(line)
+        error_message('\n'.join(lines))
+
+    def _checked_out(self):
+        ret = self.controller.checked_out()
         if ret[0] != 0:
             error_message(ret)
 
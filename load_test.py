@@ -0,0 +1,169 @@
+"""
+    Load test for Communicator against a local FakeKroger. No network access or Kroger
+    credentials needed.
+
+    Reports throughput and p50/p99 latency for single product lookups made concurrently,
+    bulk lookups and cart loads, along with how many requests actually reached the server.
+    First checks that RedirectListener catches the fake's authorization redirect.
+
+    python load_test.py --products 500 --latency .05 --error-rate .01
+"""
+
+
+import argparse
+import datetime
+import os
+import tempfile
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import Communicator
+import DBInterface
+import FakeKroger
+import RedirectListener
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    """ Nearest-rank percentile """
+    if not samples:
+        return 0.0
+    ordered: list = sorted(samples)
+    rank: int = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def report(name: str, operations: int, elapsed: float, samples: list[float], fake: FakeKroger.FakeKroger) -> None:
+    print(f'{name}')
+    print(f'    {operations} operations in {elapsed:.2f}s -- {operations / elapsed:.1f}/s')
+    print(f'    latency p50 {percentile(samples, 50) * 1000:.1f}ms  p99 {percentile(samples, 99) * 1000:.1f}ms')
+    print(f'    server requests {fake.request_counts}')
+    fake.reset_counts()
+
+
+def build_communicator(api_base: str, db_path: str, args) -> Communicator.Communicator:
+    """ Fresh database holding a fresh token pair, so startup never tries the authorization flow """
+    db_interface = DBInterface.DBInterface(db_path)
+    db_interface.seed_db()
+    now: float = datetime.datetime.now().timestamp()
+    db_interface.update_token('load-test-refresh', now, 'load-test-access', now)
+    return Communicator.Communicator(db_interface,
+                                     rate_limit=args.rate_limit,
+                                     burst=args.rate_limit,
+                                     api_base=api_base)
+
+
+def check_redirect(api_base: str, fake: FakeKroger.FakeKroger, port: int) -> tuple[int, dict]:
+    """
+    Follows the fake's authorize redirect the way the browser would, and checks
+    RedirectListener catches the code it was issued.
+    :return: (0, {'authorization_code': <>}) or (-1, {'error_message': <>})
+    """
+    redirect_uri: str = f'http://localhost:{port}'
+    listener = RedirectListener.RedirectListener(redirect_uri, expected_state='load-test')
+    ret = listener.start()
+    if ret[0] != 0:
+        return ret
+    params: str = urllib.parse.urlencode({'redirect_uri': redirect_uri, 'response_type': 'code', 'state': 'load-test'})
+    try:
+        requests.get(f'{api_base}connect/oauth2/authorize?{params}', timeout=5)
+    except requests.RequestException as e:
+        listener.stop()
+        return -1, {'error_message': f'Authorize request failed: {e}'}
+    ret = listener.wait_for_code(timeout=5)
+    if ret[0] == 0 and ret[1]['authorization_code'] != fake.issued_codes[-1]:
+        return -1, {'error_message': f"Caught {ret[1]['authorization_code']}, expected {fake.issued_codes[-1]}"}
+    return ret
+
+
+def timed(fnx, *fnx_args) -> tuple:
+    """ :return: (fnx's return value, seconds taken) """
+    started: float = time.perf_counter()
+    ret = fnx(*fnx_args)
+    return ret, time.perf_counter() - started
+
+
+def bench_lookups(communicator: Communicator.Communicator, upcs: list[str], workers: int) -> tuple:
+    """ Many callers each asking for one product. max_age=0 keeps the cache out of the measurement """
+    def lookup(upc: str) -> tuple:
+        return timed(communicator.product_details_many, [upc], Communicator.RequestScheduler.INTERACTIVE, 0)
+
+    started: float = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        outcomes: list = list(executor.map(lookup, upcs))
+    failures: int = sum(ret[0][0] != 0 for ret, _ in outcomes)
+    return time.perf_counter() - started, [elapsed for _, elapsed in outcomes], failures
+
+
+def bench_bulk(communicator: Communicator.Communicator, upcs: list[str], rounds: int) -> tuple:
+    samples: list = []
+    failures: int = 0
+    started: float = time.perf_counter()
+    for _ in range(rounds):
+        rets, elapsed = timed(communicator.product_details_many, upcs, Communicator.RequestScheduler.INTERACTIVE, 0)
+        samples.append(elapsed)
+        failures += sum(ret[0] != 0 for ret in rets)
+    return time.perf_counter() - started, samples, failures
+
+
+def bench_cart(communicator: Communicator.Communicator, upcs: list[str], rounds: int) -> tuple:
+    shopping_list: list = [{'upc': upc, 'quantity': 1} for upc in upcs]
+    samples: list = []
+    failures: int = 0
+    started: float = time.perf_counter()
+    for _ in range(rounds):
+        ret, elapsed = timed(communicator.add_to_cart, shopping_list)
+        samples.append(elapsed)
+        failures += ret[0] != 0
+    return time.perf_counter() - started, samples, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test Communicator against a local fake Kroger API')
+    parser.add_argument('--products', type=int, default=500, help='Distinct UPCs to look up')
+    parser.add_argument('--workers', type=int, default=16, help='Concurrent callers for single lookups')
+    parser.add_argument('--rounds', type=int, default=5, help='Repetitions of the bulk lookup and cart load')
+    parser.add_argument('--cart-items', type=int, default=100, help='Items per cart load')
+    parser.add_argument('--latency', type=float, default=.05, help='Seconds the fake adds to every response')
+    parser.add_argument('--jitter', type=float, default=.02)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of 500 responses')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of 429 responses')
+    parser.add_argument('--rate-limit', type=float, default=10, help="Communicator's requests per second")
+    parser.add_argument('--redirect-port', type=int, default=8765, help='Port for the authorization redirect check')
+    args = parser.parse_args()
+
+    fake = FakeKroger.FakeKroger(catalog_size=max(args.products, args.cart_items),
+                                 latency=args.latency,
+                                 jitter=args.jitter,
+                                 error_rate=args.error_rate,
+                                 throttle_rate=args.throttle_rate)
+    ret = fake.start()
+    if ret[0] != 0:
+        print(ret[1]['error_message'])
+        exit(1)
+    api_base: str = ret[1]['api_base']
+    upcs: list = [FakeKroger.FakeKroger.upc(index) for index in range(args.products)]
+    ret = check_redirect(api_base, fake, args.redirect_port)
+    if ret[0] != 0:
+        print('Authorization redirect not caught -- ' + ret[1]['error_message'])
+    else:
+        print(f"Authorization redirect caught ({ret[1]['authorization_code']})")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        communicator = build_communicator(api_base, os.path.join(tmp_dir, 'load_test.db'), args)
+        fake.reset_counts()
+        try:
+            elapsed, samples, failures = bench_lookups(communicator, upcs, args.workers)
+            report(f'Single lookups, {args.workers} concurrent callers ({failures} failed)',
+                   len(upcs), elapsed, samples, fake)
+            elapsed, samples, failures = bench_bulk(communicator, upcs, args.rounds)
+            report(f'Bulk lookups of {len(upcs)} UPCs ({failures} products failed)', args.rounds, elapsed, samples, fake)
+            elapsed, samples, failures = bench_cart(communicator, upcs[:args.cart_items], args.rounds)
+            report(f'Cart loads of {args.cart_items} items ({failures} failed)', args.rounds, elapsed, samples, fake)
+        finally:
+            communicator.token_manager.stop()
+            communicator.circuit_breaker.stop()
+            fake.stop()
+
+
+if __name__ == "__main__":
+    main()